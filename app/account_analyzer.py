@@ -1,8 +1,9 @@
 import os
 import aiofiles
-from telethon.tl.types import PeerUser
+from telethon.tl.types import PeerUser, MessageMediaPhoto, MessageMediaDocument
 from telethon.tl.functions.users import GetFullUserRequest
 from telethon.tl.functions.channels import GetFullChannelRequest
+from message_store import sender_display_name
 
 
 async def get_last_messages(client, user_id, n=5):
@@ -17,45 +18,62 @@ async def get_last_messages(client, user_id, n=5):
     return messages
 
 
-async def get_message_context(event, depth=3):
-    """Получает контекст сообщения - предыдущие сообщения в цепочке ответов"""
+async def _fetch_reply_entry(event, message_id, store=None):
+    """Загружает сообщение цепочки ответов из Telegram и кладёт его в хранилище"""
+    replied_message = await event.client.get_messages(await event.get_input_chat(), ids=message_id)
+    if not replied_message:
+        return None
+    sender = await replied_message.get_sender()
+    if store is not None:
+        store.add_message(event.chat_id, replied_message, sender)
+        return store.get(event.chat_id, message_id)
+    return {
+        'text': replied_message.text,
+        'sender_id': replied_message.sender_id,
+        'sender_name': sender_display_name(sender),
+        'reply_to_id': replied_message.reply_to_msg_id if replied_message.reply_to else None
+    }
+
+
+async def get_message_context(event, depth=3, store=None):
+    """
+    Получает контекст сообщения - предыдущие сообщения в цепочке ответов.
+    Сообщения ищутся сначала в локальном хранилище store, при промахе — в Telegram.
+    """
     context_messages = []
-    current_event = event
+    reply_to_id = event.reply_to_msg_id if event.reply_to else None
     for _ in range(depth):
-        if not current_event.reply_to:
+        if not reply_to_id:
             break
-            
+
         try:
             # Получаем сообщение, на которое отвечали
-            replied_message = await current_event.get_reply_message()
-
-            sender = await replied_message.get_sender()
-            sender_name = None
-            if sender:
-                if hasattr(sender, 'title') and sender.title:  # для каналов/групп
-                    sender_name = sender.title
-                elif hasattr(sender, 'username') and sender.username:  # для пользователей
-                    sender_name = sender.username
+            entry = store.get(event.chat_id, reply_to_id) if store is not None else None
+            if entry is None:
+                entry = await _fetch_reply_entry(event, reply_to_id, store)
 
-            if replied_message and replied_message.text:
+            if entry and entry['text']:
                 context_messages.append({
-                    'text': replied_message.text,
-                    'sender_id': replied_message.sender_id,
-                    'sender_name': sender_name
+                    'text': entry['text'],
+                    'sender_id': entry['sender_id'],
+                    'sender_name': entry['sender_name']
                 })
-                current_event = replied_message
+                reply_to_id = entry['reply_to_id']
             else:
                 break
         except Exception as e:
             print(f"Ошибка получения контекста: {e}")
-            if len(context_messages) != 0:
-                return list(reversed(context_messages))  # Возвращаем в хронологическом порядке
             break
-    
+
     return list(reversed(context_messages))  # Возвращаем в хронологическом порядке
 
 
-async def get_personal_channel_and_posts(client, user_id, n_posts=2):
+async def get_personal_channel_and_posts(client, user_id, n_posts=2, max_scan=20):
+    """
+    Возвращает (закреплённый канал, последние n_posts непересланных постов).
+    Посты — объекты Message: их медиа скачивается без повторного запроса по id.
+    История читается страницами по мере необходимости, не больше max_scan сообщений.
+    """
     full = await client(GetFullUserRequest(user_id))
     channel_id = full.full_user.personal_channel_id
     if not channel_id:
@@ -69,29 +87,98 @@ async def get_personal_channel_and_posts(client, user_id, n_posts=2):
     if not personal_channel:
         return None, []
     posts = []
-    async for msg in client.iter_messages(personal_channel, limit=20):
-        if msg.fwd_from is not None:
-            continue
-
-        posts.append({
-            "id": msg.id,
-            "text": msg.text,
-            "media": msg.media is not None
-        })
-        if len(posts) >= n_posts:
+    scanned = 0
+    offset_id = 0
+    # Страница с запасом на пересланные посты; обычно хватает одного запроса
+    page_size = n_posts + 3
+    while len(posts) < n_posts and scanned < max_scan:
+        page = await client.get_messages(
+            personal_channel, limit=min(page_size, max_scan - scanned), offset_id=offset_id)
+        if not page:
             break
+        for msg in page:
+            if msg.fwd_from is None:
+                posts.append(msg)
+                if len(posts) >= n_posts:
+                    break
+        scanned += len(page)
+        offset_id = page[-1].id
     return personal_channel, posts
 
-async def download_profile_photo(client, entity, file_path):
-    await client.download_profile_photo(entity, file=file_path)
-    return file_path if os.path.exists(file_path) else None
+# Максимальный размер скачиваемого изображения (байт)
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(5 * 1024 * 1024)))
+# Скачивать вместо оригиналов миниатюры: аватары в малом размере, для фото — наименьший
+# размер с большей стороной не меньше MEDIA_THUMBNAIL_MIN_EDGE, для видео/GIF/стикеров — превью
+MEDIA_THUMBNAIL_MODE = os.getenv("MEDIA_THUMBNAIL_MODE", "true").lower() == "true"
+MEDIA_THUMBNAIL_MIN_EDGE = int(os.getenv("MEDIA_THUMBNAIL_MIN_EDGE", "800"))
+
+
+def _limit_size(data, source):
+    if data and len(data) > MAX_IMAGE_BYTES:
+        print(f"Изображение {source} больше {MAX_IMAGE_BYTES} байт, пропускаем")
+        return None
+    return data or None
 
-async def download_media(client, message, file_path):
-    if message.media:
-        await client.download_media(message, file=file_path)
-        return file_path if os.path.exists(file_path) else None
+def pick_thumbnail(sizes, min_edge=MEDIA_THUMBNAIL_MIN_EDGE):
+    """
+    Выбирает наименьший размер миниатюры с большей стороной не меньше min_edge
+    (или наибольший из имеющихся). Возвращает тип размера для thumb= или None.
+    """
+    candidates = []
+    for size in sizes or ():
+        # Stripped/path-размеры — не настоящие изображения, у них нет w/h
+        width, height = getattr(size, 'w', None), getattr(size, 'h', None)
+        if width and height:
+            candidates.append((max(width, height), size.type))
+    if not candidates:
+        return None
+    candidates.sort()
+    for edge, size_type in candidates:
+        if edge >= min_edge:
+            return size_type
+    return candidates[-1][1]
+
+def _message_thumbnail(message):
+    # Только фото и видео/GIF/стикеры, прикреплённые к самому сообщению: превью
+    # ссылок, файлы, PDF и обложки аудио не скачиваем
+    if isinstance(message.media, MessageMediaPhoto) and message.photo:
+        return pick_thumbnail(message.photo.sizes)
+    # Видео, GIF и стикеры — скачиваем только превью документа
+    if isinstance(message.media, MessageMediaDocument) and \
+            (message.video or message.gif or message.sticker):
+        return pick_thumbnail(message.document.thumbs)
     return None
 
+def has_media_preview(message):
+    """Есть ли у сообщения изображение, которое стоит скачать для анализа"""
+    if MEDIA_THUMBNAIL_MODE:
+        return _message_thumbnail(message) is not None
+    return message.photo is not None
+
+async def download_profile_photo(client, entity):
+    """Скачивает аватар пользователя или канала в память, возвращает байты или None"""
+    data = await client.download_profile_photo(
+        entity, file=bytes, download_big=not MEDIA_THUMBNAIL_MODE)
+    return _limit_size(data, f"аватара {getattr(entity, 'id', '')}")
+
+async def download_media(client, message):
+    """Скачивает медиа сообщения (или его миниатюру) в память, возвращает байты или None"""
+    if not message.media:
+        return None
+    if MEDIA_THUMBNAIL_MODE:
+        thumb = _message_thumbnail(message)
+        if thumb is None:
+            return None
+        data = await client.download_media(message, file=bytes, thumb=thumb)
+        return _limit_size(data, f"сообщения {message.id}")
+    # Не скачиваем заведомо слишком большие файлы
+    size = getattr(message.file, 'size', None) if message.file else None
+    if size and size > MAX_IMAGE_BYTES:
+        print(f"Медиа сообщения {message.id} больше {MAX_IMAGE_BYTES} байт, пропускаем")
+        return None
+    data = await client.download_media(message, file=bytes)
+    return _limit_size(data, f"сообщения {message.id}")
+
 def build_account_json(user_id, username, full_name, channel, channel_posts, user_photo_path, channel_photo_path, post_media_paths, messages=None):
 
     data = {
@@ -0,0 +1,146 @@
+import json
+
+_SIGN_BIT = 1 << 63
+_MASK = (1 << 64) - 1
+
+
+def to_signed64(value):
+    """Переводит беззнаковый 64-битный хеш в знаковый (для колонки BIGINT)"""
+    return value - (1 << 64) if value & _SIGN_BIT else value
+
+
+def to_unsigned64(value):
+    """Обратное преобразование знакового BIGINT в беззнаковый хеш"""
+    return value & _MASK
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """BK-дерево для поиска хешей в пределах расстояния Хэмминга"""
+
+    def __init__(self):
+        self.root = None  # [hash, {расстояние: дочерний узел}]
+        self.size = 0
+
+    def add(self, value):
+        if self.root is None:
+            self.root = [value, {}]
+            self.size += 1
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Возвращает список (расстояние, хеш) в пределах max_distance"""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_value, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                found.append((distance, node_value))
+            low, high = distance - max_distance, distance + max_distance
+            for child_distance, child in children.items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+        return found
+
+
+class AvatarIndex:
+    """
+    Индекс перцептивных хешей аватаров пользователей и их каналов.
+    Находит аватары, совпадающие с аватарами подтверждённых ботов.
+    """
+
+    def __init__(self, settle_distance=2, suspect_distance=6):
+        self.settle_distance = settle_distance
+        self.suspect_distance = suspect_distance
+        self.tree = BKTree()
+        self.users_by_hash = {}
+        self.bot_user_ids = set()
+        self.lookups = 0
+        self.settled = 0
+        self.suspected = 0
+
+    def add(self, user_id, image_hash):
+        if image_hash is None:
+            return
+        users = self.users_by_hash.get(image_hash)
+        if users is None:
+            self.users_by_hash[image_hash] = {user_id}
+            self.tree.add(image_hash)
+        else:
+            users.add(user_id)
+
+    def set_label(self, user_id, is_bot):
+        if is_bot:
+            self.bot_user_ids.add(user_id)
+        else:
+            self.bot_user_ids.discard(user_id)
+
+    def find_bot_match(self, image_hash, exclude_user_id=None):
+        """Возвращает (расстояние, id бота) для ближайшего аватара бота или None"""
+        if image_hash is None:
+            return None
+        self.lookups += 1
+        best = None
+        for distance, value in self.tree.search(image_hash, self.suspect_distance):
+            if best is not None and distance >= best[0]:
+                continue
+            for user_id in self.users_by_hash.get(value, ()):
+                if user_id != exclude_user_id and user_id in self.bot_user_ids:
+                    best = (distance, user_id)
+                    break
+        return best
+
+    def check(self, image_hash, exclude_user_id=None):
+        """
+        Проверяет аватар по индексу. Возвращает:
+        - ("settle", вердикт JSON) — аватар практически идентичен аватару бота;
+        - ("suspect", пояснение) — аватар похож на аватар бота;
+        - None — совпадений нет.
+        """
+        match = self.find_bot_match(image_hash, exclude_user_id)
+        if match is None:
+            return None
+        distance, bot_user_id = match
+        if distance <= self.settle_distance:
+            self.settled += 1
+            return "settle", json.dumps({
+                "thoughts": f"Аватар совпадает с аватаром подтверждённого спам-бота {bot_user_id}",
+                "is_bot": True,
+                "confidence": 0.9
+            }, ensure_ascii=False)
+        self.suspected += 1
+        return "suspect", f"Аватар похож на аватар подтверждённого спам-бота (расстояние {distance})"
+
+    async def load(self, db):
+        """Загружает хеши аватаров и метки ботов из базы данных"""
+        for user_id in await db.get_bot_user_ids():
+            self.bot_user_ids.add(user_id)
+        for user_id, image_hash in await db.get_avatar_hashes():
+            self.add(user_id, to_unsigned64(image_hash))
+        print(f"Индекс аватаров загружен: {self.tree.size} хешей, {len(self.bot_user_ids)} ботов")
+
+    def stats(self):
+        return {
+            "hashes": self.tree.size,
+            "bot_users": len(self.bot_user_ids),
+            "lookups": self.lookups,
+            "settled": self.settled,
+            "suspected": self.suspected,
+        }
@@ -0,0 +1,66 @@
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.types import Channel, PeerChannel
+
+from cache import LRUCache
+from singleflight import SingleFlight
+
+
+async def get_linked_chat_or_channel(client, chat):
+    if isinstance(chat, Channel):
+        try:
+            full = await client(GetFullChannelRequest(chat))
+            if full.full_chat.linked_chat_id:
+                # Это значит, что у канала есть связанная группа (обсуждение)
+                linked = await client.get_entity(PeerChannel(full.full_chat.linked_chat_id))
+                return linked
+        except Exception as e:
+            print(f"Ошибка при получении привязанного чата: {e}")
+    return None
+
+
+def message_link_prefix(chat_id, chat):
+    """Начало ссылки на сообщение чата: https://t.me/<username>/ или https://t.me/c/<id>/"""
+    username = getattr(chat, 'username', None)
+    if username:
+        return f"https://t.me/{username}/"
+    chat_id_clean = str(chat_id).replace(
+        '-100', '') if str(chat_id).startswith('-100') else str(chat_id)
+    return f"https://t.me/c/{chat_id_clean}/"
+
+
+class ChatMetadataCache:
+    """
+    Кэш метаданных чатов: сущность чата, привязанный канал, username
+    и префикс ссылок на сообщения. Записи обновляются по истечении TTL.
+    """
+
+    def __init__(self, client, ttl=3600, max_size=100):
+        self.client = client
+        self._cache = LRUCache(max_size, ttl=ttl)
+        self._flights = SingleFlight()
+
+    async def get(self, chat_id, event=None):
+        """Возвращает метаданные чата; при промахе загружает их один раз на чат"""
+        info = self._cache.get(chat_id)
+        if info is not None:
+            return info
+        info, _ = await self._flights.do(chat_id, lambda: self._load(chat_id, event))
+        return info
+
+    async def _load(self, chat_id, event):
+        chat = await event.get_chat() if event is not None else await self.client.get_entity(chat_id)
+        linked_channel = await get_linked_chat_or_channel(self.client, chat)
+        info = {
+            "entity": chat,
+            "linked_channel": linked_channel,
+            "username": getattr(chat, 'username', None),
+            "link_prefix": message_link_prefix(chat_id, chat),
+        }
+        self._cache.set(chat_id, info)
+        return info
+
+    def invalidate(self, chat_id):
+        self._cache.pop(chat_id)
+
+    def stats(self):
+        return self._cache.stats()
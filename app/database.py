@@ -1,14 +1,20 @@
 import os
-from datetime import datetime
-from typing import Optional, List, Dict, Any
-from sqlalchemy import create_engine, Column, BigInteger, Integer, String, Text, Boolean, DateTime, Float, ForeignKey
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Union
+import hashlib
+from sqlalchemy import create_engine, Column, BigInteger, Integer, String, Text, Boolean, DateTime, Float, ForeignKey, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import update
+from sqlalchemy import update, delete, exists, union, or_
 from sqlalchemy.orm import selectinload
 from sqlalchemy import func, case
+from sqlalchemy.dialects.postgresql import insert
+from cache import LRUCache
+from image_utils import bytes_to_data_url, data_url_to_bytes, guess_image_mime
 
 
 Base = declarative_base()
@@ -24,7 +30,7 @@ class User(Base):
     first_name = Column(String(255))
     last_name = Column(String(255))
     full_name = Column(String(500))
-    profile_photo_base64 = Column(Text)
+    profile_photo_hash = Column(String(64))  # ссылка на image_blobs.hash
     is_bot = Column(Boolean, default=False)
     confidence = Column(Float)
     thoughts = Column(Text)
@@ -46,7 +52,7 @@ class PersonalChannel(Base):
     user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'))
     title = Column(String(255))
     username = Column(String(255))
-    photo_base64 = Column(Text)
+    photo_hash = Column(String(64))  # ссылка на image_blobs.hash
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow,
                         onupdate=datetime.utcnow)
@@ -64,7 +70,7 @@ class ChannelPost(Base):
         'personal_channels.id', ondelete='CASCADE'))
     post_id = Column(BigInteger)
     text = Column(Text)
-    media_base64 = Column(Text)
+    media_hash = Column(String(64))  # ссылка на image_blobs.hash
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Отношения
@@ -80,13 +86,41 @@ class UserMessage(Base):
     message_id = Column(BigInteger)
     text = Column(Text)
     context = Column(Text)
-    media_base64 = Column(Text)
+    media_hash = Column(String(64))  # ссылка на image_blobs.hash
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Отношения
     user = relationship("User", back_populates="messages")
 
 
+class ImageBlob(Base):
+    """Изображение, хранящееся один раз в виде байтов и адресуемое SHA-256 содержимого"""
+    __tablename__ = 'image_blobs'
+
+    hash = Column(String(64), primary_key=True)
+    mime = Column(String(50))
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class AvatarHash(Base):
+    __tablename__ = 'avatar_hashes'
+
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey('users.id', ondelete='CASCADE'))
+    kind = Column(String(16))  # user / channel
+    hash = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ModerationCacheEntry(Base):
+    __tablename__ = 'moderation_cache'
+
+    key = Column(String(64), primary_key=True)
+    verdict = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class DatabaseSQLAlchemy:
     def __init__(self):
         self.database_url = os.getenv(
@@ -97,6 +131,34 @@ class DatabaseSQLAlchemy:
         self.engine = None
         self.session_factory = None
         self.MAX_CHECKS_BEFORE_CLEANUP = 3
+        # Окно истории сообщений для анализа: последние N сообщений и/или за D дней (0 — без ограничения)
+        self.history_max_messages = int(os.getenv('USER_HISTORY_MESSAGES', '20'))
+        self.history_max_days = int(os.getenv('USER_HISTORY_DAYS', '0'))
+        # Индекс почти-дубликатов сообщений (SpamIndex), обновляется при записи
+        self.spam_index = None
+        # Индекс перцептивных хешей аватаров (AvatarIndex), получает метки ботов
+        self.avatar_index = None
+        # Кэш вердиктов пользователей: {is_bot, confidence, check_count, thoughts}
+        self.user_verdicts = LRUCache(
+            max_size=int(os.getenv('USER_VERDICT_CACHE_SIZE', '50000')))
+        # Версии вердиктов пользователей, которые сейчас читаются из БД:
+        # user_id -> [число читающих, версия]. invalidate_user увеличивает версию,
+        # и чтение, начатое до обновления, не кладёт в кэш устаревший вердикт
+        self._verdict_versions = {}
+        # Отложенная запись сообщений: строки копятся в буфере и вставляются пачкой
+        # при достижении размера или возраста буфера. Через буфер идут только сообщения,
+        # которые не анализируются сразу (save_user_message). Буфер сбрасывается при
+        # штатной остановке (close); при падении процесса несброшенные строки
+        # (до WRITE_BEHIND_MAX_ROWS или WRITE_BEHIND_MAX_AGE секунд) теряются
+        self.write_behind = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+        self.write_behind_max_rows = int(os.getenv('WRITE_BEHIND_MAX_ROWS', '200'))
+        self.write_behind_max_age = float(os.getenv('WRITE_BEHIND_MAX_AGE', '1.0'))
+        self._pending_messages = []
+        self._pending_since = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self.flushes = 0
+        self.flushed_rows = 0
 
     async def connect(self):
         """Подключение к базе данных"""
@@ -111,13 +173,69 @@ class DatabaseSQLAlchemy:
         self.session_factory = sessionmaker(
             self.engine, class_=AsyncSession, expire_on_commit=False
         )
+        if self.write_behind:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
         print("Подключение к базе данных SQLAlchemy установлено")
 
     async def close(self):
-        """Закрытие соединения с базой данных"""
+        """Закрытие соединения с базой данных (буфер сообщений записывается до закрытия)"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush_messages()
         if self.engine:
             await self.engine.dispose()
 
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.write_behind_max_age / 2)
+            if self._pending_since is not None and \
+                    time.monotonic() - self._pending_since >= self.write_behind_max_age:
+                try:
+                    await self.flush_messages()
+                except Exception as e:
+                    print(f"Ошибка отложенной записи сообщений: {e}")
+
+    async def flush_messages(self):
+        """Записывает накопленные сообщения одной многострочной вставкой"""
+        async with self._flush_lock:
+            if not self._pending_messages:
+                return
+            rows, self._pending_messages = self._pending_messages, []
+            self._pending_since = None
+            try:
+                await self._insert_messages(rows)
+            except Exception as e:
+                # Пачка не прошла целиком (например, из-за одной строки) — пишем построчно
+                print(f"Ошибка пакетной записи {len(rows)} сообщений, пишем по одному: {e}")
+                for row in rows:
+                    try:
+                        await self._insert_messages([row])
+                    except Exception as row_error:
+                        print(f"Не удалось сохранить сообщение {row['message_id']}: {row_error}")
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+
+    async def _insert_messages(self, rows):
+        async with self.session_factory() as session:
+            values = []
+            for row in rows:
+                values.append({
+                    **{key: value for key, value in row.items() if key != 'media'},
+                    'media_hash': await self._store_image(session, row['media'])
+                })
+            await session.execute(insert(UserMessage).values(values))
+            await session.commit()
+
+    def write_behind_stats(self):
+        return {
+            "enabled": self.write_behind,
+            "pending": len(self._pending_messages),
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
+
     async def save_user_message(
         self,
         user_id: int,
@@ -125,9 +243,30 @@ class DatabaseSQLAlchemy:
         message_id: int,
         text: str,
         context: Optional[str] = None,
-        media_base64: Optional[str] = None
+        media: Optional[Union[str, bytes]] = None
     ) -> bool:
-        """Сохраняет сообщение пользователя в базу данных"""
+        """
+        Сохраняет сообщение пользователя в базу данных (media — data URL или байты изображения).
+        При включённой отложенной записи сообщение попадает в буфер и пишется пачкой;
+        до сброса буфера оно не переживёт падения процесса.
+        """
+        if self.write_behind:
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+            self._pending_messages.append({
+                'user_id': user_id,
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'text': text,
+                'context': context,
+                'media': media,
+                'created_at': datetime.utcnow()
+            })
+            if self.spam_index is not None:
+                self.spam_index.add(user_id, text)
+            if len(self._pending_messages) >= self.write_behind_max_rows:
+                await self.flush_messages()
+            return True
         async with self.session_factory() as session:
             msg = UserMessage(
                 user_id=user_id,
@@ -135,61 +274,218 @@ class DatabaseSQLAlchemy:
                 message_id=message_id,
                 text=text,
                 context=context,
-                media_base64=media_base64,
+                media_hash=await self._store_image(session, media),
                 created_at=datetime.utcnow()
             )
             session.add(msg)
             await session.commit()
+        if self.spam_index is not None:
+            self.spam_index.add(user_id, text)
         return True
 
-    async def get_user_with_data(self, user_id: int) -> Optional[Dict[str, Any]]:
+    async def _store_image(self, session: AsyncSession, image: Optional[Union[str, bytes]]) -> Optional[str]:
+        """
+        Сохраняет изображение (data URL или байты) в image_blobs один раз на содержимое
+        и возвращает его хеш для ссылки из строки
+        """
+        if not image:
+            return None
+        if isinstance(image, str):
+            data, mime = data_url_to_bytes(image)
+        else:
+            data = bytes(image)
+            mime = guess_image_mime(data)
+        if not data:
+            return None
+        image_hash = hashlib.sha256(data).hexdigest()
+        # DO UPDATE вместо DO NOTHING блокирует уже существующую строку до конца
+        # транзакции: очистка (_cleanup_user_images) не удалит блоб, на который
+        # эта транзакция сейчас ставит ссылку
+        stmt = insert(ImageBlob).values(
+            hash=image_hash, mime=mime, data=data, created_at=datetime.utcnow())
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[ImageBlob.hash],
+            set_={"mime": stmt.excluded.mime}
+        ))
+        return image_hash
+
+    async def _load_images(self, session: AsyncSession, hashes) -> Dict[str, str]:
+        """Загружает изображения по хешам одним запросом и возвращает {hash: data URL}"""
+        hashes = {h for h in hashes if h}
+        if not hashes:
+            return {}
+        result = await session.execute(
+            select(ImageBlob.hash, ImageBlob.mime, ImageBlob.data)
+            .where(ImageBlob.hash.in_(hashes))
+        )
+        return {
+            image_hash: bytes_to_data_url(data, mime or "image/jpeg")
+            for image_hash, mime, data in result.all()
+        }
+
+    async def _load_user_data(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        include_images: bool = False
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Загружает данные пользователя для анализа в рамках переданной сессии.
+        Изображения загружаются только при include_images=True (для промпта LLM),
+        иначе поля *_base64 равны None.
+        """
+        stmt = (
+            select(User)
+            .where(User.id == user_id)
+            .options(
+                selectinload(User.personal_channel).selectinload(
+                    PersonalChannel.posts)
+            )
+        )
+        result = await session.execute(stmt)
+        user: Optional[User] = result.scalar_one_or_none()
+
+        if not user:
+            return None
+
+        messages = await self._load_recent_messages(session, user_id)
+
+        channel = user.personal_channel
+        channel_posts = channel.posts if channel else []
+        images = {}
+        if include_images:
+            images = await self._load_images(session, [
+                user.profile_photo_hash,
+                channel.photo_hash if channel else None,
+                *(post.media_hash for post in channel_posts)
+            ])
+
+        posts = [
+            {
+                "text": post.text,
+                "media_base64": images.get(post.media_hash)
+            }
+            for post in channel_posts
+        ]
+        return {
+            "id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "full_name": user.full_name,
+            "profile_photo_base64": images.get(user.profile_photo_hash),
+            "is_bot": user.is_bot,
+            "confidence": user.confidence,
+            "thoughts": user.thoughts,
+            "messages": [
+                f"""Контекст: {msg.context or ''} \n Сообщение: {
+                    msg.text or ''}""".strip()
+                for msg in messages
+                if msg.text or msg.context
+            ],
+            "personal_channel": {
+                "title": user.personal_channel.title,
+                "username": user.personal_channel.username,
+                "photo_base64": images.get(user.personal_channel.photo_hash),
+                "posts": posts if posts else None
+            } if user.personal_channel else None
+        }
+
+    async def _load_recent_messages(self, session: AsyncSession, user_id: int) -> List[Any]:
+        """
+        Загружает окно истории сообщений пользователя (последние history_max_messages
+        и/или за history_max_days дней) в хронологическом порядке.
+        Использует индекс (user_id, created_at DESC).
+        """
+        stmt = (
+            select(UserMessage.text, UserMessage.context)
+            .where(UserMessage.user_id == user_id)
+            .order_by(UserMessage.created_at.desc(), UserMessage.id.desc())
+        )
+        if self.history_max_days > 0:
+            since = datetime.utcnow() - timedelta(days=self.history_max_days)
+            stmt = stmt.where(UserMessage.created_at >= since)
+        if self.history_max_messages > 0:
+            stmt = stmt.limit(self.history_max_messages)
+        result = await session.execute(stmt)
+        return list(reversed(result.all()))
+
+    async def get_user_with_data(self, user_id: int, include_images: bool = False) -> Optional[Dict[str, Any]]:
         """Получает пользователя с его каналом, сообщениями и постами в канале, игнорируя служебные поля"""
+        await self.flush_messages()
         async with self.session_factory() as session:
-            stmt = (
-                select(User)
-                .where(User.id == user_id)
-                .options(
-                    selectinload(User.messages),
-                    selectinload(User.personal_channel).selectinload(
-                        PersonalChannel.posts)
-                )
-            )
-            result = await session.execute(stmt)
-            user: Optional[User] = result.scalar_one_or_none()
-
-            if not user:
-                return None
+            return await self._load_user_data(session, user_id, include_images)
 
-            posts = [
-                {
-                    "text": post.text,
-                    "media_base64": post.media_base64
-                }
-                for post in user.personal_channel.posts
-            ]
-            return {
-                "id": user.id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "full_name": user.full_name,
-                "profile_photo_base64": user.profile_photo_base64,
-                "is_bot": user.is_bot,
-                "confidence": user.confidence,
-                "thoughts": user.thoughts,
-                "messages": [
-                    f"""Контекст: {msg.context or ''} \n Сообщение: {
-                        msg.text or ''}""".strip()
-                    for msg in user.messages
-                    if msg.text or msg.context
-                ],
-                "personal_channel": {
-                    "title": user.personal_channel.title,
-                    "username": user.personal_channel.username,
-                    "photo_base64": user.personal_channel.photo_base64,
-                    "posts": posts if posts else None
-                } if user.personal_channel else None
-            }
+    async def record_message_and_load(
+        self,
+        user_id: int,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        context: Optional[str] = None,
+        media: Optional[Union[str, bytes]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Сохраняет сообщение пользователя и возвращает данные для анализа
+        (как get_user_with_data, вместе с изображениями) в одной сессии и одной транзакции
+        """
+        # Анализу нужны все сообщения пользователя, включая ещё не записанные
+        await self.flush_messages()
+        async with self.session_factory() as session:
+            session.add(UserMessage(
+                user_id=user_id,
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                context=context,
+                media_hash=await self._store_image(session, media),
+                created_at=datetime.utcnow()
+            ))
+            await session.flush()
+            user_data = await self._load_user_data(session, user_id, include_images=True)
+            await session.commit()
+        if self.spam_index is not None:
+            self.spam_index.add(user_id, text)
+        return user_data
+
+    async def get_user_verdict(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Возвращает компактный вердикт пользователя (с кэшем в памяти) или None, если его нет в БД"""
+        verdict = self.user_verdicts.get(user_id)
+        if verdict is not None:
+            return verdict
+        reading = self._verdict_versions.setdefault(user_id, [0, 0])
+        reading[0] += 1
+        version = reading[1]
+        try:
+            async with self.session_factory() as session:
+                stmt = select(
+                    User.is_bot, User.confidence, User.check_count, User.thoughts
+                ).where(User.id == user_id)
+                result = await session.execute(stmt)
+                row = result.one_or_none()
+        finally:
+            reading[0] -= 1
+            if not reading[0]:
+                self._verdict_versions.pop(user_id, None)
+        if row is None:
+            return None
+        verdict = {
+            "is_bot": row.is_bot,
+            "confidence": row.confidence,
+            "check_count": row.check_count,
+            "thoughts": row.thoughts,
+        }
+        # Пока шёл запрос, вердикт мог обновиться — тогда прочитанная строка устарела
+        if reading[1] == version:
+            self.user_verdicts.set(user_id, verdict)
+        return verdict
+
+    def invalidate_user(self, user_id: int):
+        """Сбрасывает закэшированный вердикт пользователя"""
+        reading = self._verdict_versions.get(user_id)
+        if reading:
+            reading[1] += 1
+        self.user_verdicts.pop(user_id)
 
     async def update_user_analysis(
         self,
@@ -198,7 +494,12 @@ class DatabaseSQLAlchemy:
         confidence: float,
         thoughts: str
     ) -> bool:
-        """Обновляет анализ пользователя от LLM, увеличивает счётчик проверок и очищает изображения при необходимости"""
+        """
+        Обновляет анализ пользователя от LLM, увеличивает счётчик проверок и очищает
+        изображения при достижении лимита — всё в одной транзакции
+        """
+        # Очистка изображений должна видеть и ещё не записанные сообщения
+        await self.flush_messages()
         async with self.session_factory() as session:
             # Обновляем и сразу получаем новый check_count
             stmt = (
@@ -220,60 +521,96 @@ class DatabaseSQLAlchemy:
             check_count = result.scalar()
             print(f"Updated check_count: {check_count}")
 
-            await session.commit()
-            # Если лимит достигнут — очищаем изображения
-            if check_count >= self.MAX_CHECKS_BEFORE_CLEANUP:
+            # Если лимит достигнут — очищаем изображения в той же транзакции
+            if check_count is not None and check_count >= self.MAX_CHECKS_BEFORE_CLEANUP:
                 print(f"""Очищаем изображения пользователя {
                     user_id} после {check_count} проверок""")
-                await self.cleanup_user_images(user_id)
+                await self._cleanup_user_images(session, user_id)
+
+            await session.commit()
 
+        self.invalidate_user(user_id)
+        if self.spam_index is not None:
+            self.spam_index.set_label(user_id, is_bot)
+        if self.avatar_index is not None:
+            self.avatar_index.set_label(user_id, is_bot)
         return True
 
     async def should_check_user(self, user_id: int) -> bool:
         """Проверяет, нужно ли проверять пользователя"""
-        async with self.session_factory() as session:
-            stmt = select(User.check_count).where(User.id == user_id)
-            result = await session.execute(stmt)
-            check_count = result.scalar()
+        verdict = await self.get_user_verdict(user_id)
+        check_count = verdict["check_count"] if verdict else None
+
+        print(f"CHECK_COUNT: {check_count}")
+        return check_count is None or check_count < self.MAX_CHECKS_BEFORE_CLEANUP
+
+    async def _cleanup_user_images(self, session: AsyncSession, user_id: int):
+        """Очищает изображения пользователя в рамках переданной сессии (без commit)"""
+        channel_ids = select(PersonalChannel.id).where(PersonalChannel.user_id == user_id)
+        # Хеши изображений пользователя — кандидаты на удаление из image_blobs
+        result = await session.execute(union(
+            select(User.profile_photo_hash.label("hash")).where(User.id == user_id),
+            select(PersonalChannel.photo_hash).where(PersonalChannel.user_id == user_id),
+            select(ChannelPost.media_hash).where(ChannelPost.channel_id.in_(channel_ids)),
+            select(UserMessage.media_hash).where(UserMessage.user_id == user_id)
+        ))
+        hashes = {row[0] for row in result.all() if row[0]}
+
+        # Очищаем изображение профиля
+        await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(profile_photo_hash=None)
+        )
 
-            print(f"CHECK_COUNT: {check_count}")
-            return check_count is None or check_count < self.MAX_CHECKS_BEFORE_CLEANUP
+        # Очищаем изображение канала
+        await session.execute(
+            update(PersonalChannel)
+            .where(PersonalChannel.user_id == user_id)
+            .values(photo_hash=None)
+        )
 
-    async def cleanup_user_images(self, user_id: int) -> bool:
-        """Очищает изображения пользователя после достижения лимита проверок"""
-        async with self.session_factory() as session:
-            # Очищаем изображение профиля
-            await session.execute(
-                update(User)
-                .where(User.id == user_id)
-                .values(profile_photo_base64=None)
-            )
+        # Очищаем изображения постов
+        await session.execute(
+            update(ChannelPost)
+            .where(ChannelPost.channel_id.in_(channel_ids))
+            .values(media_hash=None)
+        )
 
-            # Очищаем изображение канала
-            await session.execute(
-                update(PersonalChannel)
-                .where(PersonalChannel.user_id == user_id)
-                .values(photo_base64=None)
-            )
+        # Очищаем изображения сообщений
+        await session.execute(
+            update(UserMessage)
+            .where(UserMessage.user_id == user_id)
+            .values(media_hash=None)
+        )
 
-            # Очищаем изображения постов
+        # Удаляем изображения, на которые больше никто не ссылается. Сначала блокируем
+        # блобы (по порядку хешей, чтобы не было взаимных блокировок): параллельная
+        # запись ссылки на тот же блоб либо дождётся удаления и вставит блоб заново,
+        # либо завершится раньше, и проверка ссылок ниже её увидит
+        if hashes:
             await session.execute(
-                update(ChannelPost)
-                .where(ChannelPost.channel_id.in_(
-                    select(PersonalChannel.id).where(
-                        PersonalChannel.user_id == user_id)
-                ))
-                .values(media_base64=None)
+                select(ImageBlob.hash)
+                .where(ImageBlob.hash.in_(hashes))
+                .order_by(ImageBlob.hash)
+                .with_for_update()
             )
-
-            # Очищаем изображения сообщений
             await session.execute(
-                update(UserMessage)
-                .where(UserMessage.user_id == user_id)
-                .values(media_base64=None)
+                delete(ImageBlob)
+                .where(ImageBlob.hash.in_(hashes))
+                .where(~exists().where(User.profile_photo_hash == ImageBlob.hash))
+                .where(~exists().where(PersonalChannel.photo_hash == ImageBlob.hash))
+                .where(~exists().where(ChannelPost.media_hash == ImageBlob.hash))
+                .where(~exists().where(UserMessage.media_hash == ImageBlob.hash))
             )
 
+    async def cleanup_user_images(self, user_id: int) -> bool:
+        """Очищает изображения пользователя после достижения лимита проверок"""
+        await self.flush_messages()
+        async with self.session_factory() as session:
+            await self._cleanup_user_images(session, user_id)
             await session.commit()
+        self.invalidate_user(user_id)
         return True
 
     async def should_cleanup_images(self, user_id: int) -> bool:
@@ -284,8 +621,159 @@ class DatabaseSQLAlchemy:
             check_count = result.scalar()
             return check_count >= self.MAX_CHECKS_BEFORE_CLEANUP if check_count else False
 
+    async def get_bot_user_ids(self) -> List[int]:
+        """Возвращает id пользователей, помеченных как боты"""
+        async with self.session_factory() as session:
+            result = await session.execute(select(User.id).where(User.is_bot == True))
+            return list(result.scalars().all())
+
+    async def iter_labeled_accounts(
+        self,
+        min_confidence: float = 0.0,
+        exclude_thoughts_prefix: Optional[str] = None,
+        batch_size: int = 500
+    ):
+        """
+        Потоково отдаёт (user_id, is_bot, данные аккаунта) пользователей с вердиктом
+        для обучения предклассификатора. Данные — в формате get_user_with_data без
+        изображений, с тем же окном истории сообщений (_load_recent_messages):
+        последние history_max_messages сообщений и/или за history_max_days дней
+        до последнего сообщения пользователя (в рантайме анализ идёт сразу после него).
+        """
+        last_id = None
+        while True:
+            async with self.session_factory() as session:
+                stmt = (
+                    select(User)
+                    .where(User.confidence != None, User.confidence >= min_confidence)
+                    .options(selectinload(User.personal_channel).selectinload(PersonalChannel.posts))
+                    .order_by(User.id)
+                    .limit(batch_size)
+                )
+                if exclude_thoughts_prefix:
+                    stmt = stmt.where(or_(
+                        User.thoughts == None, ~User.thoughts.startswith(exclude_thoughts_prefix)))
+                if last_id is not None:
+                    stmt = stmt.where(User.id > last_id)
+                users = (await session.execute(stmt)).scalars().all()
+                if not users:
+                    return
+                # Окно истории считается в SQL, как LIMIT в _load_recent_messages:
+                # пустые сообщения занимают место в окне и отбрасываются уже после
+                window = (
+                    select(
+                        UserMessage.user_id, UserMessage.text, UserMessage.context,
+                        UserMessage.created_at, UserMessage.id,
+                        func.row_number().over(
+                            partition_by=UserMessage.user_id,
+                            order_by=(UserMessage.created_at.desc(), UserMessage.id.desc())
+                        ).label("position"),
+                        func.max(UserMessage.created_at).over(
+                            partition_by=UserMessage.user_id).label("last_at")
+                    )
+                    .where(UserMessage.user_id.in_([user.id for user in users]))
+                    .subquery()
+                )
+                stmt = select(window.c.user_id, window.c.text, window.c.context)
+                if self.history_max_messages > 0:
+                    stmt = stmt.where(window.c.position <= self.history_max_messages)
+                if self.history_max_days > 0:
+                    stmt = stmt.where(
+                        window.c.created_at >= window.c.last_at - timedelta(days=self.history_max_days))
+                result = await session.execute(
+                    stmt.order_by(window.c.user_id, window.c.created_at, window.c.id))
+            messages = {}
+            for user_id, text, context in result.all():
+                if text or context:
+                    messages.setdefault(user_id, []).append(
+                        f"""Контекст: {context or ''} \n Сообщение: {text or ''}""".strip())
+            for user in users:
+                channel = user.personal_channel
+                history = messages.get(user.id, [])
+                yield user.id, bool(user.is_bot), {
+                    "username": user.username,
+                    "full_name": user.full_name,
+                    "messages": history,
+                    "personal_channel": {
+                        "title": channel.title,
+                        "username": channel.username,
+                        "posts": [{"text": post.text} for post in channel.posts] or None
+                    } if channel else None
+                }
+            last_id = users[-1].id
+
+    async def iter_message_texts(self, batch_size: int = 5000):
+        """Потоково отдаёт (user_id, text) всех сообщений пользователей"""
+        async with self.session_factory() as session:
+            stmt = (
+                select(UserMessage.user_id, UserMessage.text)
+                .where(UserMessage.text != None)
+                .execution_options(yield_per=batch_size)
+            )
+            result = await session.stream(stmt)
+            async for user_id, text in result:
+                yield user_id, text
+
+    async def save_avatar_hashes(self, user_id: int, hashes: Dict[str, int]) -> bool:
+        """Сохраняет перцептивные хеши аватаров пользователя ({kind: hash})"""
+        if not hashes:
+            return True
+        async with self.session_factory() as session:
+            session.add_all([
+                AvatarHash(user_id=user_id, kind=kind, hash=value)
+                for kind, value in hashes.items()
+            ])
+            await session.commit()
+        return True
+
+    async def get_avatar_hashes(self) -> List[tuple]:
+        """Возвращает все сохранённые хеши аватаров как (user_id, hash)"""
+        async with self.session_factory() as session:
+            result = await session.execute(select(AvatarHash.user_id, AvatarHash.hash))
+            return [tuple(row) for row in result.all()]
+
+    async def get_moderation_verdict(self, key: str, max_age: Optional[int] = None) -> Optional[str]:
+        """Возвращает закэшированный вердикт модерации, если он не устарел"""
+        async with self.session_factory() as session:
+            stmt = select(ModerationCacheEntry.verdict).where(
+                ModerationCacheEntry.key == key)
+            if max_age:
+                stmt = stmt.where(ModerationCacheEntry.created_at >=
+                                  datetime.utcnow() - timedelta(seconds=max_age))
+            result = await session.execute(stmt)
+            return result.scalar_one_or_none()
+
+    async def delete_expired_moderation_verdicts(self, max_age: int) -> int:
+        """Удаляет вердикты модерации старше max_age секунд, возвращает число удалённых"""
+        async with self.session_factory() as session:
+            result = await session.execute(
+                delete(ModerationCacheEntry)
+                .where(ModerationCacheEntry.created_at < datetime.utcnow() - timedelta(seconds=max_age))
+            )
+            await session.commit()
+            return result.rowcount
+
+    async def save_moderation_verdict(self, key: str, verdict: str) -> bool:
+        """Сохраняет вердикт модерации в кэш (перезаписывая старый)"""
+        async with self.session_factory() as session:
+            now = datetime.utcnow()
+            stmt = (
+                insert(ModerationCacheEntry)
+                .values(key=key, verdict=verdict, created_at=now)
+                .on_conflict_do_update(
+                    index_elements=[ModerationCacheEntry.key],
+                    set_={"verdict": verdict, "created_at": now}
+                )
+            )
+            await session.execute(stmt)
+            await session.commit()
+        return True
+
     async def save_user(self, user_data: Dict[str, Any]) -> bool:
-        """Сохранение пользователя с использованием SQLAlchemy"""
+        """
+        Сохранение пользователя с использованием SQLAlchemy.
+        Изображения (profile_photo, photo канала, media постов) — байты или data URL.
+        """
         async with self.session_factory() as session:
             # Создаем или обновляем пользователя
             user = User(
@@ -294,7 +782,8 @@ class DatabaseSQLAlchemy:
                 first_name=user_data.get('first_name'),
                 last_name=user_data.get('last_name'),
                 full_name=user_data.get('full_name'),
-                profile_photo_base64=user_data.get('profile_photo_base64'),
+                profile_photo_hash=await self._store_image(
+                    session, user_data.get('profile_photo')),
                 is_bot=user_data.get('is_bot', False),
                 confidence=user_data.get('confidence'),
                 thoughts=user_data.get('thoughts')
@@ -309,21 +798,28 @@ class DatabaseSQLAlchemy:
                     user_id=user_data['user_id'],
                     title=channel_data.get('title'),
                     username=channel_data.get('username'),
-                    photo_base64=channel_data.get('photo_base64')
+                    photo_hash=await self._store_image(
+                        session, channel_data.get('photo'))
                 )
-                await session.merge(channel)
+                channel = await session.merge(channel)
+                # Получаем id канала для ссылок из постов
+                await session.flush()
 
-                # Сохраняем посты
+                # Сохраняем посты одной многострочной вставкой
                 if channel_data.get('last_posts'):
+                    posts = []
                     for post_data in channel_data['last_posts']:
-                        post = ChannelPost(
-                            channel_id=channel.id,
-                            text=post_data.get('text'),
-                            media_base64=post_data.get('media_base64')
-                        )
-                        session.add(post)
+                        posts.append({
+                            'channel_id': channel.id,
+                            'text': post_data.get('text'),
+                            'media_hash': await self._store_image(
+                                session, post_data.get('media')),
+                            'created_at': datetime.utcnow()
+                        })
+                    await session.execute(insert(ChannelPost).values(posts))
 
             await session.commit()
+        self.invalidate_user(user_data['user_id'])
         return True
 
 
@@ -0,0 +1,87 @@
+import asyncio
+
+from account_analyzer import (
+    get_personal_channel_and_posts, download_profile_photo, download_media, has_media_preview
+)
+
+
+class EnrichmentCoordinator:
+    """
+    Выполняет запросы обогащения аккаунта параллельно: не больше per_user
+    одновременных запросов на пользователя и max_concurrent на весь бот.
+    Каждый запрос ограничен timeout; упавший или не успевший запрос даёт None,
+    и анализ продолжается с частичными данными.
+    """
+
+    def __init__(self, max_concurrent=16, per_user=4, timeout=15):
+        self.per_user = per_user
+        self.timeout = timeout
+        self._global = asyncio.Semaphore(max_concurrent)
+        self.fetches = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    async def fetch(self, user_slots, name, func, *args):
+        """Выполняет один запрос под семафорами; при ошибке или таймауте возвращает None"""
+        async with user_slots, self._global:
+            self.fetches += 1
+            try:
+                return await asyncio.wait_for(func(*args), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                print(f"Таймаут при получении {name}")
+            except Exception as e:
+                self.failures += 1
+                print(f"Ошибка при получении {name}: {e}")
+            return None
+
+    async def enrich(self, client, user_id, user, prepare_image, n_posts=2):
+        """
+        Собирает закреплённый канал, посты и изображения аккаунта.
+        Аватар скачивается одновременно с поиском канала, фото канала и медиа
+        постов — одновременно друг с другом, как только канал найден.
+        Возвращает {"channel", "posts", "user_photo", "channel_photo"}.
+        """
+        user_slots = asyncio.Semaphore(self.per_user)
+
+        async def fetch_image(download, *args):
+            return await prepare_image(await download(*args))
+
+        async def fetch_channel():
+            return await get_personal_channel_and_posts(client, user_id, n_posts=n_posts)
+
+        user_photo_task = asyncio.ensure_future(
+            self.fetch(user_slots, "аватара", fetch_image, download_profile_photo, client, user)
+            if user else asyncio.sleep(0))
+        try:
+            channel, posts = await self.fetch(user_slots, "канала и постов", fetch_channel) or (None, [])
+
+            channel_photo, *post_media = await asyncio.gather(
+                self.fetch(user_slots, "фото канала", fetch_image, download_profile_photo, client, channel)
+                if channel else asyncio.sleep(0),
+                *(
+                    self.fetch(user_slots, "медиа поста", fetch_image, download_media, client, post)
+                    if post.media is not None and has_media_preview(post) else asyncio.sleep(0)
+                    for post in posts
+                )
+            )
+            user_photo = await user_photo_task
+        finally:
+            user_photo_task.cancel()
+
+        return {
+            "channel": channel,
+            "posts": [
+                {'text': post.text, 'media': media}
+                for post, media in zip(posts, post_media)
+            ],
+            "user_photo": user_photo,
+            "channel_photo": channel_photo,
+        }
+
+    def stats(self):
+        return {
+            "fetches": self.fetches,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+        }
@@ -1,16 +1,154 @@
 import base64
+import hashlib
+import os
+import threading
+from io import BytesIO
 from pathlib import Path
+from PIL import Image, ImageOps
+
+from cache import LRUCache
+
+# Параметры нормализации изображений перед сохранением и отправкой в LLM
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1024"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG или WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "256"))
+
+_FORMAT_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# Производные изображения по хешу исходника: повторные аватары и пересланные
+# картинки не пережимаются заново
+derived_images = LRUCache(IMAGE_CACHE_SIZE)
+# normalize_image выполняется в пуле потоков, а LRUCache не потокобезопасен
+_derived_images_lock = threading.Lock()
+
+def bytes_to_data_url(data, mime_type="image/jpeg"):
+    """Кодирует байты изображения в base64 data URL."""
+    encoded_string = base64.b64encode(data).decode('utf-8')
+    return f"data:{mime_type};base64,{encoded_string}"
+
+
+def guess_image_mime(data):
+    """Определяет MIME-тип изображения по сигнатуре файла."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def data_url_to_bytes(data_url):
+    """Декодирует base64 data URL в (байты, MIME-тип). Для некорректных данных возвращает (None, None)."""
+    if not data_url or not data_url.startswith("data:") or ";base64," not in data_url:
+        return None, None
+    header, encoded = data_url.split(",", 1)
+    mime_type = header[len("data:"):].split(";", 1)[0] or "image/jpeg"
+    try:
+        return base64.b64decode(encoded), mime_type
+    except Exception as e:
+        print(f"Ошибка декодирования data URL: {e}")
+        return None, None
+
+
+def _reencode(data, max_edge, image_format, quality):
+    with Image.open(BytesIO(data)) as image:
+        source_format = image.format
+        # Учитываем ориентацию из EXIF и берём первый кадр анимации
+        image = ImageOps.exif_transpose(image)
+        needs_resize = max(image.size) > max_edge
+        if not needs_resize and source_format == image_format:
+            return data, _FORMAT_MIME[image_format]
+        if needs_resize:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            if image_format == "JPEG":
+                # JPEG не поддерживает прозрачность — кладём на белый фон
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=True)
+        encoded = output.getvalue()
+    # Пережатие без уменьшения не должно раздувать уже компактный файл
+    if not needs_resize and len(encoded) >= len(data):
+        return data, guess_image_mime(data)
+    return encoded, _FORMAT_MIME[image_format]
+
+
+def normalize_image(data, max_edge=None, image_format=None, quality=None):
+    """
+    Приводит изображение к виду для хранения и промпта: определяет реальный формат,
+    уменьшает до max_edge по большей стороне и пережимает в JPEG/WEBP.
+    Возвращает (байты, MIME-тип) или (None, None), если это не изображение.
+    Блокирующая функция — из асинхронного кода вызывать через asyncio.to_thread.
+    """
+    if not data:
+        return None, None
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    image_format = (image_format or IMAGE_FORMAT).upper()
+    if image_format not in _FORMAT_MIME:
+        image_format = "JPEG"
+    quality = quality or IMAGE_QUALITY
+
+    key = (hashlib.sha256(data).hexdigest(), max_edge, image_format, quality)
+    with _derived_images_lock:
+        cached = derived_images.get(key)
+    if cached is not None:
+        return cached
+    try:
+        result = _reencode(bytes(data), max_edge, image_format, quality)
+    except Exception as e:
+        print(f"Ошибка нормализации изображения: {e}")
+        return None, None
+    with _derived_images_lock:
+        derived_images.set(key, result)
+    return result
+
 
 def encode_image_to_base64(image_path):
-    """Encodes an image to a base64 data URL."""
+    """Кодирует файл изображения в base64 data URL (после нормализации)."""
     if not image_path or not Path(image_path).exists():
         return None
     try:
         with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            # Для простоты предполагаем jpeg, но можно добавить определение MIME-типа
-            mime_type = "image/jpeg" 
-            return f"data:{mime_type};base64,{encoded_string}"
+            data, mime_type = normalize_image(image_file.read())
     except Exception as e:
         print(f"Ошибка кодирования изображения {image_path}: {e}")
-        return None 
\ No newline at end of file
+        return None
+    if data is None:
+        return None
+    return bytes_to_data_url(data, mime_type)
+
+
+def compute_dhash(image_source, hash_size=8):
+    """
+    Вычисляет перцептивный dHash изображения (64-битное целое для hash_size=8).
+    image_source — путь к файлу или байты изображения.
+    """
+    try:
+        if isinstance(image_source, (bytes, bytearray)):
+            image = Image.open(BytesIO(image_source))
+        else:
+            if not image_source or not Path(image_source).exists():
+                return None
+            image = Image.open(image_source)
+        with image:
+            image = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+            pixels = list(image.getdata())
+    except Exception as e:
+        print(f"Ошибка вычисления хеша изображения: {e}")
+        return None
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
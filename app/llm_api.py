@@ -1,7 +1,12 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 import os
+import asyncio
+import json
+import httpx
 from dotenv import load_dotenv
 from image_utils import encode_image_to_base64
+from model_router import ModelRouter
+from verdict_cache import ModerationVerdictCache, make_moderation_key
 import requests
 import base64
 
@@ -12,11 +17,112 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 BASE_URL = 'https://openrouter.ai/api/v1'
 MODELS_TO_TRY = ["mistralai/mistral-small-3.2-24b-instruct:free", "google/gemini-2.5-flash-lite-preview-06-17"]
 
-# Инициализация клиента OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY, base_url=BASE_URL)
+# Настройки асинхронного клиента LLM
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MODEL_CONCURRENCY = int(os.getenv("LLM_MODEL_CONCURRENCY", "5"))
+
+# Настройки маршрутизации по моделям
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "0"))  # 0 — без хеджирования
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.8"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+LLM_EWMA_ALPHA = float(os.getenv("LLM_EWMA_ALPHA", "0.2"))
+
+# Кэш вердиктов модерации по нормализованному тексту
+MODERATION_CACHE_SIZE = int(os.getenv("MODERATION_CACHE_SIZE", "10000"))
+MODERATION_CACHE_TTL = int(os.getenv("MODERATION_CACHE_TTL", "3600"))
+
+# Бюджет промпта анализа аккаунта (оценка в токенах, включая изображения)
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "6000"))
+LLM_IMAGE_TOKENS = int(os.getenv("LLM_IMAGE_TOKENS", "800"))
+LLM_CHARS_PER_TOKEN = int(os.getenv("LLM_CHARS_PER_TOKEN", "3"))
+LLM_PROMPT_ITEM_MAX_CHARS = int(os.getenv("LLM_PROMPT_ITEM_MAX_CHARS", "1000"))
+
+# Общий пул HTTP-соединений для всех запросов к LLM
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS
+    ),
+    timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+)
+
+# Инициализация асинхронного клиента OpenAI (не блокирует event loop)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=BASE_URL, http_client=http_client)
+
+# Ограничения на число одновременных запросов к каждой модели
+_model_semaphores = {}
+
+
+def get_model_semaphore(model_name):
+    """Возвращает семафор, ограничивающий параллельные запросы к модели"""
+    semaphore = _model_semaphores.get(model_name)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(LLM_MODEL_CONCURRENCY)
+        _model_semaphores[model_name] = semaphore
+    return semaphore
+
+
+async def create_completion(model_name, messages):
+    """Выполняет запрос к модели с ограничением параллельности и таймаутом"""
+    async with get_model_semaphore(model_name):
+        return await asyncio.wait_for(
+            client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=0.01,
+            ),
+            timeout=LLM_REQUEST_TIMEOUT
+        )
+
+
+def is_valid_json_response(response):
+    """Ответ модели считается валидным, если это JSON-объект"""
+    if not response:
+        return False
+    try:
+        return isinstance(json.loads(response), dict)
+    except (TypeError, ValueError):
+        return False
+
+
+router = ModelRouter(
+    MODELS_TO_TRY,
+    call=create_completion,
+    validate=is_valid_json_response,
+    hedge_after=LLM_HEDGE_AFTER,
+    failure_threshold=LLM_BREAKER_FAILURES,
+    error_rate_threshold=LLM_BREAKER_ERROR_RATE,
+    cooldown=LLM_BREAKER_COOLDOWN,
+    alpha=LLM_EWMA_ALPHA
+)
+
+
+moderation_cache = ModerationVerdictCache(
+    max_size=MODERATION_CACHE_SIZE,
+    ttl=MODERATION_CACHE_TTL
+)
+
 
-def get_antibot_prompt(account_json, user_name, chat_language="ru"):
-    prompt_for_spam = f'''Определи, является ли пользователь {user_name} спам-ботом. Используй признаки:
+def get_llm_metrics():
+    """Метрики маршрутизатора моделей и кэша модерации"""
+    metrics = router.metrics()
+    metrics["moderation_cache"] = moderation_cache.stats()
+    return metrics
+
+
+async def close_llm_client():
+    """Закрывает пул HTTP-соединений клиента LLM"""
+    await client.close()
+
+# Неизменяемая часть промпта антиспама: идёт первой и побайтово совпадает между
+# запросами, чтобы провайдеры с кэшированием промптов переиспользовали её
+ANTIBOT_SYSTEM_PROMPT = '''Ты фильтр, который определяет, является ли аккаунт спам-ботом.
+
+Определи, является ли пользователь спам-ботом. Используй признаки:
 1. Реклама, поиск работы/заработка  
 2. Часто от женских имён: заготовки в виде восторженных рецензий на фильмы/сериалы/мультфильмы; шаблонные, вежливо-слащавые тексты без реакции на чат; иногда только смайлик ❤️  
 
@@ -50,10 +156,28 @@ def get_antibot_prompt(account_json, user_name, chat_language="ru"):
 Будет представлен список из сообщений пользователя messages, в нем:
 "Контекст" — это предыдущее сообщение, на которое пользователь отвечает.
 "Сообщение" — это собственный текст пользователя. Обязательно обращай внимание на сообщения пользователя, если они однотипные, то это признак бота
-Ответь в формате JSON: { '{' }\"thoughts\":..., \"is_bot\": true/false, \"confidence\": 0-1 { '}'}
+Ответь в формате JSON: {"thoughts": ..., "is_bot": true/false, "confidence": 0-1}'''
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов текста (без токенизатора конкретной модели)"""
+    return len(text) // LLM_CHARS_PER_TOKEN + 1
+
+
+class PromptBudget:
+    """Остаток бюджета токенов промпта"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def take(self, tokens):
+        """Резервирует tokens, если они помещаются в бюджет"""
+        if self.used + tokens > self.limit:
+            return False
+        self.used += tokens
+        return True
 
-ВАЖНО: используй язык чата — {chat_language.upper()} — для ответа в поле "thoughts".\n\nДанные: {account_json}'''
-    return prompt_for_spam
 
 def remove_none_values(obj):
     if isinstance(obj, dict):
@@ -67,104 +191,114 @@ def remove_none_values(obj):
     else:
         return obj
 
-def preprocess_account_data_for_llm(account_json_pre):
-    account_json = account_json_pre.copy()
-    # Удаляем поля с изображениями
-    account_json = account_json.copy()
-    account_json.pop("profile_photo_base64", None)
-
-    if "personal_channel" in account_json:
-        account_json["personal_channel"] = account_json["personal_channel"].copy()
-        account_json["personal_channel"].pop("photo_base64", None)
-
-        if "posts" in account_json["personal_channel"]:
-            if account_json["personal_channel"]["posts"]:
-                for post in account_json["personal_channel"]["posts"]:
-                    post.pop("media_base64", None)
 
+def _clip(text, max_chars):
+    return text if len(text) <= max_chars else text[:max_chars] + "…"
+
+
+def _image_item(url):
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def build_account_content(account_json, chat_language="ru", token_budget=None,
+                          system_prompt=ANTIBOT_SYSTEM_PROMPT, extra_text=""):
+    """
+    Собирает содержимое запроса для анализа аккаунта в пределах бюджета токенов.
+    Профиль входит всегда, остальное — по приоритету, пока хватает бюджета:
+    сообщения (сначала новые), аватар, тексты постов, аватар канала, медиа постов.
+    Инструкции в содержимое не входят — они в system_prompt. Из бюджета вычитаются
+    system_prompt и extra_text — текст, который вызывающий добавит в запрос сам.
+    """
+    budget = PromptBudget(
+        (token_budget or LLM_PROMPT_TOKEN_BUDGET)
+        - estimate_tokens(system_prompt)
+        - (estimate_tokens(extra_text) if extra_text else 0)
+    )
+    channel = account_json.get('personal_channel') or {}
+    images = {
+        "profile_photo_base64": account_json.get('profile_photo_base64'),
+        "photo_base64": channel.get('photo_base64'),
+    }
+
+    profile = remove_none_values({
+        key: value for key, value in account_json.items()
+        if key not in ("id", "messages", "personal_channel", "profile_photo_base64")
+    })
+    header = (
+        f"ВАЖНО: используй язык чата — {chat_language.upper()} — для ответа в поле \"thoughts\".\n\n"
+        "Данные:\n"
+    )
+    budget.take(estimate_tokens(header) + estimate_tokens(json.dumps(profile, ensure_ascii=False)))
 
-    account_json = remove_none_values(account_json)
+    # Сообщения пользователя: новые важнее, в промпт — в хронологическом порядке
+    messages = []
+    for message in reversed(account_json.get('messages') or []):
+        message = _clip(message, LLM_PROMPT_ITEM_MAX_CHARS)
+        if not budget.take(estimate_tokens(message)):
+            break
+        messages.append(message)
+    messages.reverse()
+
+    profile_photo = images["profile_photo_base64"] if images["profile_photo_base64"] and \
+        budget.take(LLM_IMAGE_TOKENS) else None
+
+    posts = channel.get('posts') or []
+    post_texts = []
+    for post in posts:
+        text = _clip(post.get('text') or "", LLM_PROMPT_ITEM_MAX_CHARS)
+        if text and not budget.take(estimate_tokens(text)):
+            break
+        post_texts.append(text)
+
+    channel_photo = images["photo_base64"] if images["photo_base64"] and \
+        budget.take(LLM_IMAGE_TOKENS) else None
+
+    post_media = [
+        post['media_base64'] for post in posts
+        if post.get('media_base64') and budget.take(LLM_IMAGE_TOKENS)
+    ]
 
-    if account_json.get("personal_channel") == {}:
-        account_json.pop("personal_channel")
-    return account_json
+    data = dict(profile)
+    if messages:
+        data["messages"] = messages
+    if channel:
+        data["personal_channel"] = remove_none_values({
+            "title": channel.get('title'),
+            "username": channel.get('username'),
+            "posts": [text for text in post_texts if text] or None,
+        })
+    content = [{"type": "text", "text": header + json.dumps(data, ensure_ascii=False)}]
+    if profile_photo:
+        content.append({"type": "text", "text": "Аватарка пользователя:"})
+        content.append(_image_item(profile_photo))
+    if channel_photo:
+        content.append({"type": "text", "text": "Аватарка канала:"})
+        content.append(_image_item(channel_photo))
+    if post_media:
+        content.append({"type": "text", "text": "Изображения из постов канала:"})
+        content.extend(_image_item(url) for url in post_media)
+    print(f'Промпт антиспама: ~{budget.used} токенов из {budget.limit}')
+    return content
 
 async def analyze_account_with_llm(account_json, chat_language="ru"):
-    account_json_processed = preprocess_account_data_for_llm(account_json)
-    print('account_json: ', account_json_processed)
     # Формируем сообщения для LLM
-    system_prompt = "Ты фильтр, который определяет, является ли аккаунт спам-ботом."
     messages = [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": ANTIBOT_SYSTEM_PROMPT},
         {
             "role": "user",
-            "content": [
-                {"type": "text", "text": get_antibot_prompt(account_json_processed, chat_language)}
-            ]
+            "content": build_account_content(account_json, chat_language)
         }
     ]
-    if account_json['profile_photo_base64']:
-        messages[1]["content"].append({
-            "type": "text",
-            "text": "Аватарка пользователя:"
-        })
 
-        messages[1]["content"].append({
-            "type": "image_url",
-            "image_url": {"url": account_json['profile_photo_base64']}
-        })
-
-    if account_json['personal_channel']:
-        personal_channel = account_json['personal_channel']
-        if personal_channel['photo_base64']:
-            messages[1]["content"].append({
-                "type": "text",
-                "text": "Аватарка канала:"
-            })
-
-            messages[1]["content"].append({
-                "type": "image_url",
-                "image_url": {"url": personal_channel['photo_base64']}
-            })
-            if personal_channel['posts']:
-                for p in personal_channel['posts']:
-                    if p['text']:
-                        messages[1]["content"].append({
-                            "type": "text",
-                            "text": p['text']
-                        })
-                    if p['media_base64']:
-                        messages[1]["content"].append({
-                            "type": "image_url",
-                            "image_url": {"url": p['media_base64']}
-                    })
-
-    for model_name in MODELS_TO_TRY:
-        try:
-            completion = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                response_format={"type": "json_object"},
-                temperature=0.01,
-            )
-        except Exception as e:
-            print(f"Ошибка при обращении к OpenAI API модель {model_name}: {e}")
-            continue 
-    response = completion.choices[0].message.content
+    response = await router.route(messages)
     print(f'АНТИСПАМБОТ ответ: {response}')
     return response
 
-async def moderate_message_with_llm(message_text, user_name, image_path=None, is_bot=None, dialog_context=None, chat_language='ru', channel_name=None):
+def get_moderation_rules(channel_name):
     # Формируем prompt для модерации
     channel_description = 'Канал гиковской тематики'
     sensitivity = "low"  # можно менять на high/medium в зависимости от настроек канала
-    messages = []
-
-# system prompt
-    messages.append({
-        "role": "system",
-        "content": (
-            f"""Ты модерируешь чат (канал: {channel_name}, описание канала: {channel_description}).\n
+    return f"""Ты модерируешь чат (канал: {channel_name}, описание канала: {channel_description}).\n
 Модерируй только если сообщение направлено на живого участника ЧАТА и содержит:
 
 1. Прямое оскорбление (пример: "ты долбоёб").
@@ -179,7 +313,45 @@ async def moderate_message_with_llm(message_text, user_name, image_path=None, is
 **Сенситивность {sensitivity.upper()}**:
 - LOW: флагай только очевидные нарушения.
 - MEDIUM: флагай, если скорее всего нарушение.
-- HIGH: флагай и потенциальные нарушения.
+- HIGH: флагай и потенциальные нарушения."""
+
+# Заглушка вместо имени автора проверяемого сообщения: закэшированный вердикт
+# не привязан к автору, имя подставляется в ответ при выдаче
+AUTHOR_PLACEHOLDER = "[автор]"
+AUTHOR_NOTE = (
+    f"Автор проверяемого сообщения обозначен как {AUTHOR_PLACEHOLDER}. В moderation_message "
+    f"обращайся к нему именно так: {AUTHOR_PLACEHOLDER} — имя подставится автоматически."
+)
+
+
+def personalize_verdict(response, user_name):
+    """Подставляет имя автора вместо заглушки в JSON-ответ модерации"""
+    if not response:
+        return response
+    # Имя экранируется как строка JSON, чтобы кавычки в нём не ломали ответ
+    name = json.dumps(str(user_name), ensure_ascii=False)[1:-1]
+    return response.replace(AUTHOR_PLACEHOLDER, name)
+
+
+async def moderate_message_with_llm(message_text, user_name, image_path=None, is_bot=None, dialog_context=None, chat_language='ru', channel_name=None):
+    # Одинаковые тексты (копипаста) в одинаковом контексте получают закэшированный вердикт
+    cache_key = None
+    if not image_path:
+        cache_key = make_moderation_key(message_text, dialog_context, channel_name, chat_language)
+        cached = await moderation_cache.get(cache_key)
+        if cached is not None:
+            print(f'Вердикт модерации из кэша: {cached}')
+            return personalize_verdict(cached, user_name)
+
+    messages = []
+
+# system prompt
+    messages.append({
+        "role": "system",
+        "content": (
+            f"""{get_moderation_rules(channel_name)}
+
+{AUTHOR_NOTE}
 
 Ответ в JSON-формате:
 {{
@@ -201,7 +373,7 @@ async def moderate_message_with_llm(message_text, user_name, image_path=None, is
 # добавляем проверяемое сообщение
     messages.append({
         "role": "user",
-        "content": f"{user_name}: {message_text}"
+        "content": f"{AUTHOR_PLACEHOLDER}: {message_text}"
     })
 
 # добавляем запрос на модерацию
@@ -220,17 +392,177 @@ async def moderate_message_with_llm(message_text, user_name, image_path=None, is
                 "image_url": {"url": base64_image}
             })
 
-    for model_name in MODELS_TO_TRY:
-        try:
-            completion = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                response_format={"type": "json_object"},
-                temperature=0.01,
-            )
-        except Exception as e:
-            print(f"Ошибка при обращении к OpenAI API модель {model_name}: {e}")
-            continue 
-    response = completion.choices[0].message.content
+    response = await router.route(messages)
     print(f'Для Входа: {messages}\n Ответ: {response}')
-    return response 
+    if cache_key and response is not None:
+        await moderation_cache.set(cache_key, response)
+    return personalize_verdict(response, user_name)
+
+
+async def moderate_messages_batch_with_llm(items, chat_language='ru', channel_name=None):
+    """
+    Модерирует несколько сообщений одного чата одним запросом к LLM.
+    items — список словарей {"id", "message_text", "user_name", "dialog_context", "is_bot"}.
+    Возвращает JSON-строки вердиктов (в формате moderate_message_with_llm) в порядке items.
+    """
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        cache_key = make_moderation_key(
+            item['message_text'], item['dialog_context'], channel_name, chat_language)
+        cached = await moderation_cache.get(cache_key)
+        if cached is not None:
+            results[index] = personalize_verdict(cached, item['user_name'])
+        else:
+            pending.append((index, item, cache_key))
+    if not pending:
+        return results
+
+    async def moderate_single(item):
+        return await moderate_message_with_llm(
+            item['message_text'],
+            item['user_name'],
+            is_bot=item['is_bot'],
+            dialog_context=item['dialog_context'],
+            chat_language=chat_language,
+            channel_name=channel_name
+        )
+
+    # Пакет из одного сообщения выгоднее отправить обычным запросом
+    if len(pending) == 1:
+        index, item, _ = pending[0]
+        results[index] = await moderate_single(item)
+        return results
+
+    system_prompt = (
+        f"""{get_moderation_rules(channel_name)}
+
+Тебе придёт список сообщений чата, у каждого свой id. Модерируй каждое сообщение отдельно,
+контекст диалога учитывай только для того сообщения, к которому он относится.
+{AUTHOR_NOTE}
+
+Ответ в JSON-формате:
+{{
+  "verdicts": [
+    {{
+      "id": <id сообщения>,
+      "thoughts": "<объяснение>",
+      "is_violating": true/false,
+      "action": "warn"/"delete_and_ban"/"",
+      "moderation_message": "<сообщение для пользователя, если нужно>"
+    }}
+  ]
+}}"""
+    )
+    batch = [
+        {
+            "id": item['id'],
+            "context": [
+                f"{msg['sender_name']}: {msg['text']}"
+                for msg in (item['dialog_context'] or [])
+            ],
+            "message": f"{AUTHOR_PLACEHOLDER}: {item['message_text']}"
+        }
+        for _, item, _ in pending
+    ]
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": json.dumps(batch, ensure_ascii=False)},
+        {
+            "role": "user",
+            "content": (
+                f"Нарушают ли эти сообщения правила? Дай вердикт для каждого id. "
+                f"Ответь в формате JSON, как указано выше. Язык чата — {chat_language.upper()}."
+            )
+        }
+    ]
+
+    response = await router.route(messages)
+    print(f'ПАКЕТНАЯ модерация ({len(pending)} сообщений): {response}')
+    if response is None:
+        return results
+    try:
+        verdicts = {
+            str(verdict.get("id")): verdict
+            for verdict in json.loads(response).get("verdicts", [])
+            if isinstance(verdict, dict)
+        }
+    except (AttributeError, ValueError):
+        verdicts = {}
+
+    for index, item, cache_key in pending:
+        verdict = verdicts.get(str(item['id']))
+        if verdict is None:
+            # Модель пропустила сообщение — проверяем его отдельно
+            results[index] = await moderate_single(item)
+            continue
+        response_json = json.dumps({
+            "thoughts": verdict.get("thoughts", ""),
+            "is_violating": verdict.get("is_violating", False),
+            "action": verdict.get("action", ""),
+            "moderation_message": verdict.get("moderation_message", "")
+        }, ensure_ascii=False)
+        await moderation_cache.set(cache_key, response_json)
+        results[index] = personalize_verdict(response_json, item['user_name'])
+    return results
+
+
+async def analyze_and_moderate_with_llm(account_json, message_text, user_name, dialog_context=None, chat_language='ru', channel_name=None):
+    """
+    Один запрос к LLM для нового пользователя: проверка аккаунта на спам-бота
+    и модерация текущего сообщения. Возвращает пару JSON-строк в тех же форматах,
+    что и analyze_account_with_llm и moderate_message_with_llm.
+    """
+    # Статический префикс антиспама идёт первым, правила модерации с названием канала — после
+    system_prompt = (
+        f"{ANTIBOT_SYSTEM_PROMPT}\n\n"
+        "Ты также модератор чата.\n\n"
+        f"{get_moderation_rules(channel_name)}"
+    )
+
+    dialog_lines = [
+        f"{msg['sender_name']}: {msg['text']}"
+        for msg in (dialog_context or [])
+    ]
+    moderation_task = "\n\n---\nЗАДАЧА 2: модерация последнего сообщения пользователя.\n"
+    if dialog_lines:
+        moderation_task += "Контекст диалога:\n" + "\n".join(dialog_lines) + "\n"
+    moderation_task += (
+        f"Проверяемое сообщение:\n{user_name}: {message_text}\n\n"
+        f"Нарушает ли это последнее сообщение правила? Проверь ТОЛЬКО его. Язык чата — {chat_language.upper()}.\n\n"
+        "Ответь одним JSON-объектом, объединяющим обе задачи:\n"
+        "{\"thoughts\": \"<объяснение по спам-боту>\", \"is_bot\": true/false, \"confidence\": 0-1, "
+        "\"moderation_thoughts\": \"<объяснение по модерации>\", \"is_violating\": true/false, "
+        "\"action\": \"warn\"/\"delete_and_ban\"/\"\", "
+        "\"moderation_message\": \"<сообщение для пользователя, если нужно>\"}"
+    )
+    content = build_account_content(
+        account_json, chat_language, system_prompt=system_prompt, extra_text=moderation_task)
+    content.append({"type": "text", "text": moderation_task})
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
+
+    response = await router.route(messages)
+    print(f'КОМБИНИРОВАННЫЙ ответ: {response}')
+    if response is None:
+        return None, None
+    try:
+        result = json.loads(response)
+    except ValueError:
+        return response, response
+
+    antibot_response = json.dumps({
+        "thoughts": result.get("thoughts", ""),
+        "is_bot": result.get("is_bot", False),
+        "confidence": result.get("confidence", 0)
+    }, ensure_ascii=False)
+    moderation_response = json.dumps({
+        "thoughts": result.get("moderation_thoughts", ""),
+        "is_violating": result.get("is_violating", False),
+        "action": result.get("action", ""),
+        "moderation_message": result.get("moderation_message", "")
+    }, ensure_ascii=False)
+    return antibot_response, moderation_response
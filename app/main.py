@@ -1,23 +1,36 @@
 import os
+import signal
 from pathlib import Path
 import json
 import asyncio
 from telethon import TelegramClient, events
 from telethon.tl.functions.users import GetFullUserRequest
 from telethon.tl.types import PeerUser
-from telethon.tl.types import Channel, Chat, PeerChannel
-from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.types import Chat
 from dotenv import load_dotenv
 from account_analyzer import (
-    get_last_messages, get_personal_channel_and_posts, get_message_context,
-    download_profile_photo, download_media, build_account_json
+    get_last_messages, get_message_context,
+    download_media, has_media_preview, build_account_json
 )
 from telethon.tl.custom import Button  # Импортируем Button для inline-кнопок
-from llm_api import analyze_account_with_llm, moderate_message_with_llm
-from telethon.tl.functions.channels import GetParticipantsRequest
-from telethon.tl.types import ChannelParticipantsSearch, User
-from image_utils import encode_image_to_base64
+from llm_api import (
+    analyze_account_with_llm, moderate_message_with_llm, analyze_and_moderate_with_llm,
+    moderate_messages_batch_with_llm,
+    close_llm_client, get_llm_metrics, moderation_cache
+)
+from telethon.tl.types import User
+from image_utils import compute_dhash, normalize_image
 from database import db
+from spam_index import SpamIndex
+from avatar_index import AvatarIndex, to_signed64
+from pipeline import Pipeline, Stage
+from singleflight import SingleFlight
+from participants import ParticipantIndex
+from chat_cache import ChatMetadataCache
+from message_store import MessageStore
+from enrichment import EnrichmentCoordinator
+from preclassifier import PreClassifier
+from moderation_batcher import MicroBatcher
 
 
 # load_dotenv("mine.env")
@@ -27,6 +40,39 @@ TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 
 TOTAL_ACCOUT_CHECKS = 1
+STATS_LOG_INTERVAL = int(os.getenv("STATS_LOG_INTERVAL", "300"))  # 0 — не логировать
+# Один запрос к LLM для нового пользователя (анализ аккаунта + модерация)
+COMBINED_LLM_PASS = os.getenv("COMBINED_LLM_PASS", "false").lower() == "true"
+# Хранить кэш вердиктов модерации в Postgres (переживает перезапуски)
+MODERATION_CACHE_DB = os.getenv("MODERATION_CACHE_DB", "false").lower() == "true"
+# Локальное обнаружение шаблонных сообщений ботов без обращения к LLM
+SPAM_INDEX_ENABLED = os.getenv("SPAM_INDEX_ENABLED", "true").lower() == "true"
+# Сравнение аватаров с аватарами подтверждённых ботов по перцептивному хешу
+AVATAR_INDEX_ENABLED = os.getenv("AVATAR_INDEX_ENABLED", "true").lower() == "true"
+AVATAR_SETTLE_DISTANCE = int(os.getenv("AVATAR_SETTLE_DISTANCE", "2"))
+AVATAR_SUSPECT_DISTANCE = int(os.getenv("AVATAR_SUSPECT_DISTANCE", "6"))
+# Конвейер обработки сообщений: воркеры на этап и размер очередей между этапами
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "4"))
+PIPELINE_NOTIFY_WORKERS = int(os.getenv("PIPELINE_NOTIFY_WORKERS", "2"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "100"))
+# Период фонового обновления индекса участников чатов (секунды, 0 — только при запуске)
+PARTICIPANTS_REFRESH_INTERVAL = int(os.getenv("PARTICIPANTS_REFRESH_INTERVAL", "3600"))
+# Время жизни кэша метаданных чатов (сущность, привязанный канал, ссылки), секунды
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "3600"))
+# Сколько последних сообщений каждого чата хранить для контекста ответов
+MESSAGE_STORE_SIZE = int(os.getenv("MESSAGE_STORE_SIZE", "1000"))
+# Параллельное обогащение новых аккаунтов: лимиты одновременных запросов и таймаут запроса
+ENRICH_MAX_CONCURRENT = int(os.getenv("ENRICH_MAX_CONCURRENT", "16"))
+ENRICH_PER_USER = int(os.getenv("ENRICH_PER_USER", "4"))
+ENRICH_TIMEOUT = float(os.getenv("ENRICH_TIMEOUT", "15"))
+# Локальный предклассификатор аккаунтов (файл модели из preclassifier.py train; пусто — выключен)
+PRECLASSIFIER_MODEL = os.getenv("PRECLASSIFIER_MODEL", "")
+# Переопределение порогов модели: ниже отрицательного — человек, выше положительного — бот
+PRECLASSIFIER_NEGATIVE = os.getenv("PRECLASSIFIER_NEGATIVE")
+PRECLASSIFIER_POSITIVE = os.getenv("PRECLASSIFIER_POSITIVE")
+# Пакетная модерация: сообщения чата за окно (мс) или до N штук — одним запросом (0 — выключена)
+MODERATION_BATCH_WINDOW_MS = int(os.getenv("MODERATION_BATCH_WINDOW_MS", "0"))
+MODERATION_BATCH_SIZE = int(os.getenv("MODERATION_BATCH_SIZE", "8"))
 IGNORED_USER_IDS = [8045161528, 7347675444, -1001705454724]
 
 session_dir = Path("/data/session")
@@ -50,32 +96,105 @@ ALLOWED_CHAT_IDS = [
     # -1001393881014
 ]
 
+spam_index = SpamIndex()
+# Участники разрешённых чатов для поиска отправителя без перебора списка
+participant_index = ParticipantIndex(user_client)
+# Метаданные разрешённых чатов, общие для модерации и уведомлений
+chat_cache = ChatMetadataCache(user_client, ttl=CHAT_CACHE_TTL)
+# Недавние сообщения чатов: цепочки ответов собираются без запросов к Telegram
+message_store = MessageStore(MESSAGE_STORE_SIZE)
+enrichment = EnrichmentCoordinator(
+    max_concurrent=ENRICH_MAX_CONCURRENT,
+    per_user=ENRICH_PER_USER,
+    timeout=ENRICH_TIMEOUT
+)
+# Один анализ аккаунта на пользователя в каждый момент времени
+user_analysis_flights = SingleFlight()
 
-def delete_local_files(file_paths):
-    """Удаляет список локальных файлов."""
-    for path in file_paths:
-        try:
-            if Path(path).exists() and Path(path).is_file():
-                os.remove(path)
-                print(f"Удален локальный файл: {path}")
-            else:
-                print(
-                    f"Файл не найден или не является файлом, пропуск удаления: {path}")
-        except Exception as e:
-            print(f"Ошибка при удалении файла {path}: {e}")
 
+def match_spam_index(message_text, user_id):
+    """Возвращает локальный вердикт, если сообщение похоже на сообщения известных ботов"""
+    if not SPAM_INDEX_ENABLED:
+        return None
+    verdict = spam_index.match(message_text, exclude_user_id=user_id)
+    if verdict:
+        print('Сообщение совпало с кластером спам-ботов, LLM не вызываем')
+    return verdict
+
+
+avatar_index = AvatarIndex(
+    settle_distance=AVATAR_SETTLE_DISTANCE,
+    suspect_distance=AVATAR_SUSPECT_DISTANCE
+)
+
+
+async def moderate_chat_batch(items):
+    """Модерирует пакет сообщений одного чата (контекст чата берётся из первого)"""
+    return await moderate_messages_batch_with_llm(items, channel_name=items[0]['channel_name'])
+
+
+moderation_batcher = MicroBatcher(
+    moderate_chat_batch,
+    window=MODERATION_BATCH_WINDOW_MS / 1000,
+    max_size=MODERATION_BATCH_SIZE
+) if MODERATION_BATCH_WINDOW_MS > 0 else None
+
+
+# Загружается в main(), если задан PRECLASSIFIER_MODEL
+preclassifier = None
+
+
+def preclassify_account(account_json):
+    """Возвращает локальный вердикт для однозначных аккаунтов, иначе None (нужен LLM)"""
+    if preclassifier is None:
+        return None
+    verdict = preclassifier.verdict(account_json)
+    if verdict:
+        print('Аккаунт однозначно классифицирован локально, LLM не вызываем')
+    return verdict
 
-async def get_linked_chat_or_channel(client, chat):
-    if isinstance(chat, Channel):
-        try:
-            full = await client(GetFullChannelRequest(chat))
-            if full.full_chat.linked_chat_id:
-                # Это значит, что у канала есть связанная группа (обсуждение)
-                linked = await client.get_entity(PeerChannel(full.full_chat.linked_chat_id))
-                return linked
-        except Exception as e:
-            print(f"Ошибка при получении привязанного чата: {e}")
-    return None
+
+async def prepare_image(data):
+    """Уменьшает и пережимает скачанное изображение вне цикла событий"""
+    if not data:
+        return None
+    normalized, _ = await asyncio.to_thread(normalize_image, data)
+    return normalized
+
+
+async def check_avatars(user_id, image_sources):
+    """
+    Считает перцептивные хеши аватаров ({kind: байты}) и сверяет их с аватарами ботов.
+    Возвращает (хеши, вердикт или None, пояснения {kind: текст}).
+    """
+    hashes, verdict, notes = {}, None, {}
+    if not AVATAR_INDEX_ENABLED:
+        return hashes, verdict, notes
+    for kind, source in image_sources.items():
+        if not source:
+            continue
+        image_hash = await asyncio.to_thread(compute_dhash, source)
+        if image_hash is None:
+            continue
+        hashes[kind] = image_hash
+        result = avatar_index.check(image_hash, exclude_user_id=user_id)
+        if result is None:
+            continue
+        status, payload = result
+        if status == "settle":
+            print(f'Аватар ({kind}) совпал с аватаром спам-бота, LLM не вызываем')
+            verdict = verdict or payload
+        notes[kind] = payload if status == "suspect" else "Аватар совпадает с аватаром спам-бота"
+    return hashes, verdict, notes
+
+
+async def remember_avatars(user_id, hashes):
+    """Сохраняет хеши аватаров в БД и в индекс"""
+    if not hashes:
+        return
+    await db.save_avatar_hashes(user_id, {kind: to_signed64(value) for kind, value in hashes.items()})
+    for value in hashes.values():
+        avatar_index.add(user_id, value)
 
 
 async def resolve_user_info(client, event):
@@ -95,37 +214,15 @@ async def resolve_user_info(client, event):
     except:
         pass
 
-    # 2. Если не удалось — ищем среди участников
+    # 2. Если не удалось — ищем в индексе участников (при промахе — точечный запрос)
     if not user or not isinstance(user, User):
         try:
-            chat = await event.get_chat()
-            offset = 0
-            limit = 200
-
-            while True:
-                participants = await client(GetParticipantsRequest(
-                    channel=chat,
-                    filter=ChannelParticipantsSearch(""),
-                    offset=offset,
-                    limit=limit,
-                    hash=0
-                ))
-
-                if not participants.users:
-                    break
-
-                for u in participants.users:
-                    if u.id == event.sender_id:
-                        user = u
-                        break
-
-                if user:
-                    break
-
-                offset += len(participants.users)
-
+            chat_info = await chat_cache.get(event.chat_id, event)
+            user = await participant_index.lookup(chat_info["entity"], event.chat_id, event.sender_id)
         except Exception as e:
             print(f"Ошибка при поиске участника в чате: {e}")
+    else:
+        participant_index.add(event.chat_id, user)
 
     # 3. Собираем информацию
     if user and isinstance(user, User):
@@ -149,19 +246,39 @@ async def resolve_user_info(client, event):
 
 @user_client.on(events.NewMessage(chats=ALLOWED_CHAT_IDS))
 async def handler(event):
-    user_id = event.sender_id
-    chat_id = event.chat_id
-    message_text = event.raw_text
-
-    if chat_id not in ALLOWED_CHAT_IDS:
+    if event.chat_id not in ALLOWED_CHAT_IDS:
         return
 
-    if int(user_id) in IGNORED_USER_IDS:
+    # Запоминаем сообщение для контекста будущих ответов (отправитель — только из кэша)
+    message_store.add_message(event.chat_id, event.message, event.sender)
+
+    if int(event.sender_id) in IGNORED_USER_IDS:
         print('Игнорируем')
         return
 
-    chat = await event.get_chat()
-    linked_channel = await get_linked_chat_or_channel(user_client, chat)
+    # Ставим сообщение в конвейер; при заполненной очереди ждём (backpressure)
+    await pipeline.submit({"event": event, "chat_id": event.chat_id})
+
+
+@user_client.on(events.ChatAction(chats=ALLOWED_CHAT_IDS))
+async def participants_handler(event):
+    """Поддерживает индекс участников в актуальном состоянии"""
+    if event.user_joined or event.user_added:
+        for user in await event.get_users():
+            participant_index.add(event.chat_id, user)
+    elif event.user_left or event.user_kicked:
+        for user_id in event.user_ids or ():
+            participant_index.remove(event.chat_id, user_id)
+
+
+async def enrich_stage(ctx):
+    """Этап 1: контекст диалога, медиа сообщения и информация об отправителе"""
+    event = ctx['event']
+    user_id = event.sender_id
+    message_text = event.raw_text
+
+    chat_info = await chat_cache.get(event.chat_id, event)
+    linked_channel = chat_info["linked_channel"]
     if linked_channel:
         print(f"Привязанный канал: {linked_channel.title}")
     else:
@@ -170,7 +287,7 @@ async def handler(event):
     # Создание контекста диалога
     dialog_context = ""
     if event.reply_to:
-        dialog_context = await get_message_context(event)
+        dialog_context = await get_message_context(event, store=message_store)
     if dialog_context:
         print(f"Найдено {len(dialog_context)} сообщений контекста")
 
@@ -186,15 +303,11 @@ async def handler(event):
                 context_text += f"""\nОт {msg['sender_name']
                                         }: {msg['text'][:100]}"""
 
-    files_to_delete = []
-    message_media_base64 = None
-    if event.media and hasattr(event.media, 'photo'):
-        # Скачиваем изображение во временный файл
-        temp_image_path = f"media/message_{event.id}_media.jpg"
-        files_to_delete.append(temp_image_path)
-        await download_media(user_client, event.message, temp_image_path)
-        # Конвертируем в base64
-        message_media_base64 = encode_image_to_base64(temp_image_path)
+    message_media = None
+    if event.media and has_media_preview(event.message):
+        # Скачиваем изображение сразу в память
+        message_media = await prepare_image(
+            await download_media(user_client, event.message))
 
 
     # Получаем информацию о пользователе
@@ -202,6 +315,9 @@ async def handler(event):
     full_name = user_data['full_name']
     username = user_data['username']
     user = user_data['user']
+    if user:
+        # Дополняем сохранённое сообщение именем отправителя
+        message_store.add_message(event.chat_id, event.message, user)
 
     name_for_current_user = None
     if full_name:
@@ -211,9 +327,64 @@ async def handler(event):
     else:
         name_for_current_user = user_id
 
-    # Проверяем, есть ли пользователь в базе данных
-    existing_user = await db.get_user_with_data(user_id)
+    ctx.update({
+        "user_id": user_id,
+        "message_text": message_text,
+        "chat_info": chat_info,
+        "linked_channel": linked_channel,
+        "dialog_context": dialog_context,
+        "context_text": context_text,
+        "message_media": message_media,
+        "user": user,
+        "username": username,
+        "full_name": full_name,
+        "name_for_current_user": name_for_current_user,
+    })
+    return ctx
+
+
+async def analyze_stage(ctx):
+    """
+    Этап 2: проверка аккаунта на спам-бота (локально или с LLM).
+    Одновременные сообщения одного пользователя ждут уже идущий анализ
+    и используют его вердикт.
+    """
+    user_id = ctx['user_id']
+    result, shared = await user_analysis_flights.do(user_id, lambda: analyze_user(ctx))
+    if shared:
+        print(f'Анализ пользователя {user_id} уже выполняется, используем его результат')
+        if result['recorded']:
+            event = ctx['event']
+            await db.save_user_message(
+                user_id, ctx['chat_id'], event.id, ctx['message_text'],
+                ctx['context_text'], None if result['history_only'] else ctx['message_media'])
+        # Комбинированный ответ модерации относится к чужому сообщению
+        result = dict(result, moderation_result=None)
+    ctx.update({"is_bot": result['is_bot'], "moderation_result": result['moderation_result']})
+    return ctx
+
+
+async def analyze_user(ctx):
+    """Анализирует отправителя сообщения: новый пользователь, повторная проверка или кэш БД"""
+    event = ctx['event']
+    user_id = ctx['user_id']
+    chat_id = ctx['chat_id']
+    message_text = ctx['message_text']
+    linked_channel = ctx['linked_channel']
+    dialog_context = ctx['dialog_context']
+    context_text = ctx['context_text']
+    message_media = ctx['message_media']
+    user = ctx['user']
+    username = ctx['username']
+    full_name = ctx['full_name']
+    name_for_current_user = ctx['name_for_current_user']
+
+    # Проверяем, есть ли пользователь в базе данных (вердикт кэшируется в памяти)
+    existing_user = await db.get_user_verdict(user_id)
     is_bot = False
+    moderation_result = None
+    recorded = False
+    history_only = False
 
     if existing_user:
 
@@ -221,15 +392,18 @@ async def handler(event):
         if await db.should_check_user(user_id):
             print('Доп. проверка')
 
-            await db.save_user_message(user_id, chat_id, event.id, message_text, context_text, message_media_base64 or "")
-
-            updated_user_data = await db.get_user_with_data(user_id)
-            messages = existing_user.get('messages', [])
+            # Сохраняем сообщение и получаем данные для анализа одной транзакцией
+            updated_user_data = await db.record_message_and_load(
+                user_id, chat_id, event.id, message_text, context_text, message_media)
+            recorded = True
 
             if updated_user_data:
 
-                # Анализируем с LLM
-                llm_result = await analyze_account_with_llm(updated_user_data)
+                # Анализируем локально по индексу спама, иначе — с LLM
+                llm_result = match_spam_index(message_text, user_id) or \
+                    preclassify_account(updated_user_data)
+                if llm_result is None:
+                    llm_result = await analyze_account_with_llm(updated_user_data)
                 try:
                     llm_result_json = json.loads(llm_result)
                 except Exception:
@@ -247,69 +421,71 @@ async def handler(event):
                 is_bot = llm_result_json.get("is_bot", False)
         else:
             print('Доп. проверка не требуется')
+            # С отложенной записью сохраняем текст для истории без обращения к БД
+            # (буфер пишется пачкой). Без неё путь доверенных пользователей остаётся
+            # без запросов к БД; медиа не сохраняем — их уже никто не очистит
+            if db.write_behind:
+                await db.save_user_message(
+                    user_id, chat_id, event.id, message_text, context_text)
+                recorded = history_only = True
             # Используем существующие данные
             is_bot = existing_user.get('is_bot', False)
     else:
 
         print(f'Пользователь не найден в базе данных, анализируем...')
 
-        # Собираем информацию об аккаунте
-        try:
-            channel, posts = await get_personal_channel_and_posts(user_client, user_id, n_posts=2)
-        except Exception as e:
-            print('ОШИБКА ПРИ ПОЛУЧЕНИИ КАНАЛА И ПОСТОВ', e)
-            channel, posts = None, []
-
-        # Скачиваем и конвертируем изображения в base64
-        user_photo_base64 = None
-        if user:
-            user_photo_path = f"media/user_{user_id}_photo.jpg"
-            files_to_delete.append(user_photo_path)
-            await download_profile_photo(user_client, user, user_photo_path)
-            user_photo_base64 = encode_image_to_base64(user_photo_path)
-
-        channel_photo_base64 = None
-        if channel:
-            channel_photo_path = f"media/channel_{channel.id}_photo.jpg"
-            files_to_delete.append(channel_photo_path)
-            await download_profile_photo(user_client, channel, channel_photo_path)
-            channel_photo_base64 = encode_image_to_base64(channel_photo_path)
-
-        # Обрабатываем посты
-        posts_with_media = []
-        for post in posts:
-            post_data = {'text': post['text'], 'media_base64': None}
-            if post["media"]:
-                post_media_path = f"media/post_{post['id']}_media.jpg"
-                files_to_delete.append(post_media_path)
-                msg_obj = await user_client.get_messages(channel, ids=post["id"])
-                await download_media(user_client, msg_obj, post_media_path)
-                post_data['media_base64'] = encode_image_to_base64(
-                    post_media_path)
-            posts_with_media.append(post_data)
+        # Собираем информацию об аккаунте: канал, посты и изображения загружаются параллельно
+        enriched = await enrichment.enrich(user_client, user_id, user, prepare_image, n_posts=2)
+        channel = enriched["channel"]
+        user_photo = enriched["user_photo"]
+        channel_photo = enriched["channel_photo"]
+        posts_with_media = enriched["posts"]
+
+        # Сверяем аватары с аватарами известных ботов; совпавшие не отправляем в LLM
+        avatar_hashes, avatar_verdict, avatar_notes = await check_avatars(
+            user_id, {"user": user_photo, "channel": channel_photo})
+        if "user" in avatar_notes:
+            user_photo = None
+        if "channel" in avatar_notes:
+            channel_photo = None
 
         # Формируем данные пользователя
         user_data_for_db = {
             'user_id': user_id,
             'username': username,
             'full_name': full_name,
-            'profile_photo_base64': user_photo_base64,
+            'profile_photo': user_photo,
             'personal_channel': {
                 'title': channel.title if channel else None,
                 'username': channel.username if channel else None,
-                'photo_base64': channel_photo_base64,
+                'photo': channel_photo,
                 'last_posts': posts_with_media
             }
         }
 
         # Сохраняем пользователя в базу данных
         await db.save_user(user_data_for_db)
+        await remember_avatars(user_id, avatar_hashes)
 
-        await db.save_user_message(user_id, chat_id, event.id, message_text, context_text, message_media_base64 or "")
-        # Получаем полные данные для анализа
-        account_json = await db.get_user_with_data(user_id)
+        # Сохраняем сообщение и получаем полные данные для анализа
+        account_json = await db.record_message_and_load(
+            user_id, chat_id, event.id, message_text, context_text, message_media)
+        recorded = True
         if account_json:
-            llm_result = await analyze_account_with_llm(account_json)
+            if avatar_notes:
+                account_json['avatar_suspicion'] = list(avatar_notes.values())
+            llm_result = avatar_verdict or match_spam_index(message_text, user_id) or \
+                preclassify_account(account_json)
+            if llm_result is None and COMBINED_LLM_PASS:
+                llm_result, moderation_result = await analyze_and_moderate_with_llm(
+                    account_json,
+                    message_text,
+                    name_for_current_user,
+                    dialog_context=dialog_context,
+                    channel_name=linked_channel
+                )
+            elif llm_result is None:
+                llm_result = await analyze_account_with_llm(account_json)
             try:
                 llm_result_json = json.loads(llm_result)
             except Exception:
@@ -326,16 +502,39 @@ async def handler(event):
             )
             is_bot = llm_result_json.get("is_bot", False)
 
-
-    # Модерация сообщения
-    moderation_result = await moderate_message_with_llm(
-        message_text,
-        name_for_current_user,
-        image_path=None,  # Теперь изображение уже в base64 в БД
-        is_bot=is_bot,
-        dialog_context=dialog_context,
-        channel_name=linked_channel
-    )
+    return {"is_bot": is_bot, "moderation_result": moderation_result,
+            "recorded": recorded, "history_only": history_only}
+
+
+async def moderate_stage(ctx):
+    """Этап 3: модерация сообщения"""
+    message_text = ctx['message_text']
+    name_for_current_user = ctx['name_for_current_user']
+    dialog_context = ctx['dialog_context']
+    linked_channel = ctx['linked_channel']
+    is_bot = ctx['is_bot']
+    moderation_result = ctx['moderation_result']
+
+    # Модерация сообщения (если она не выполнена вместе с анализом аккаунта)
+    if moderation_result is None and moderation_batcher is not None:
+        # Сообщения чата, пришедшие почти одновременно, модерируются одним запросом
+        moderation_result = await moderation_batcher.submit(ctx['chat_id'], {
+            "id": ctx['event'].id,
+            "message_text": message_text,
+            "user_name": name_for_current_user,
+            "dialog_context": dialog_context,
+            "is_bot": is_bot,
+            "channel_name": linked_channel,
+        })
+    elif moderation_result is None:
+        moderation_result = await moderate_message_with_llm(
+            message_text,
+            name_for_current_user,
+            image_path=None,  # Теперь изображение уже в base64 в БД
+            is_bot=is_bot,
+            dialog_context=dialog_context,
+            channel_name=linked_channel
+        )
     try:
         moderation_json = json.loads(moderation_result)
     except Exception:
@@ -343,30 +542,35 @@ async def handler(event):
         moderation_json = {"thoughts": moderation_result,
                            "is_violating": False, "action": "", "moderation_message": ""}
 
-    # Удаляем временные файлы
-    if len(files_to_delete) > 0:
-        delete_local_files(files_to_delete)
+    # Уведомлять администратора нужно только о ботах и нарушениях
+    if not is_bot and not moderation_json.get('is_violating'):
+        return None
+
+    ctx["moderation_json"] = moderation_json
+    return ctx
+
+
+async def notify_stage(ctx):
+    """Этап 4: уведомление администратора (по порядку сообщений в чате)"""
+    event = ctx['event']
+    user_id = ctx['user_id']
+    chat_id = ctx['chat_id']
+    is_bot = ctx['is_bot']
+    moderation_json = ctx['moderation_json']
 
     # Обработка результатов модерации
     violating_user_id = user_id
     violating_chat_id = chat_id
     if is_bot:
-        # Получаем актуальные данные пользователя для отображения
-        current_user = await db.get_user_with_data(user_id)
+        # Получаем актуальный вердикт пользователя для отображения
+        current_user = await db.get_user_verdict(user_id)
         reason = current_user.get(
             'thoughts', 'Причина не указана') if current_user else 'Причина не указана'
         confidence = current_user.get('confidence', 0) if current_user else 0
         original_text = event.message.text
 
         if event.chat_id:
-            chat_entity = await event.get_chat()
-            if hasattr(chat_entity, 'username') and chat_entity.username:
-                message_link = f"""https://t.me/{
-                    chat_entity.username}/{event.id}"""
-            else:
-                chat_id_clean = str(event.chat_id).replace(
-                    '-100', '') if str(event.chat_id).startswith('-100') else str(event.chat_id)
-                message_link = f"https://t.me/c/{chat_id_clean}/{event.id}"
+            message_link = f"{ctx['chat_info']['link_prefix']}{event.id}"
 
         if original_text != "":
             forward_message_text = (
@@ -414,14 +618,7 @@ async def handler(event):
         current_warnings = 0
 
         if event.chat_id:
-            chat_entity = await event.get_chat()
-            if hasattr(chat_entity, 'username') and chat_entity.username:
-                message_link = f"""https://t.me/{
-                    chat_entity.username}/{event.id}"""
-            else:
-                chat_id_clean = str(event.chat_id).replace(
-                    '-100', '') if str(event.chat_id).startswith('-100') else str(event.chat_id)
-                message_link = f"https://t.me/c/{chat_id_clean}/{event.id}"
+            message_link = f"{ctx['chat_info']['link_prefix']}{event.id}"
 
         if original_text != "":
             forward_message_text = (
@@ -465,24 +662,134 @@ async def handler(event):
             buttons=buttons
         )
 
+
+pipeline = Pipeline(
+    [
+        Stage("enrich", enrich_stage, workers=PIPELINE_WORKERS),
+        Stage("analyze", analyze_stage, workers=PIPELINE_WORKERS),
+        # При пакетной модерации воркеров должно хватать, чтобы набрать полный пакет
+        Stage("moderate", moderate_stage, workers=max(
+            PIPELINE_WORKERS, MODERATION_BATCH_SIZE if moderation_batcher else 0)),
+        Stage("notify", notify_stage, workers=PIPELINE_NOTIFY_WORKERS),
+    ],
+    queue_size=PIPELINE_QUEUE_SIZE,
+    key=lambda ctx: ctx['chat_id']
+)
+
+
+async def log_stats_periodically():
+    """Периодически выводит метрики компонентов бота"""
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        print(f"МЕТРИКИ LLM: {json.dumps(get_llm_metrics(), ensure_ascii=False)}")
+        print(f"МЕТРИКИ КОНВЕЙЕРА: {json.dumps(pipeline.stats(), ensure_ascii=False)}")
+        print(f"МЕТРИКИ SINGLE-FLIGHT: {user_analysis_flights.stats()}")
+        print(f"МЕТРИКИ УЧАСТНИКОВ: {participant_index.stats()}")
+        print(f"МЕТРИКИ КЭША ЧАТОВ: {chat_cache.stats()}")
+        print(f"МЕТРИКИ ХРАНИЛИЩА СООБЩЕНИЙ: {message_store.stats()}")
+        print(f"МЕТРИКИ ОБОГАЩЕНИЯ: {enrichment.stats()}")
+        if db.write_behind:
+            print(f"МЕТРИКИ ОТЛОЖЕННОЙ ЗАПИСИ: {db.write_behind_stats()}")
+        if SPAM_INDEX_ENABLED:
+            print(f"МЕТРИКИ ИНДЕКСА СПАМА: {spam_index.stats()}")
+        if AVATAR_INDEX_ENABLED:
+            print(f"МЕТРИКИ ИНДЕКСА АВАТАРОВ: {avatar_index.stats()}")
+        if preclassifier is not None:
+            print(f"МЕТРИКИ ПРЕДКЛАССИФИКАТОРА: {preclassifier.stats()}")
+        if moderation_batcher is not None:
+            print(f"МЕТРИКИ ПАКЕТНОЙ МОДЕРАЦИИ: {moderation_batcher.stats()}")
+
+
+def log_spam_index_load(task):
+    """Сообщает об ошибке фоновой загрузки индекса спама"""
+    if not task.cancelled() and task.exception():
+        print(f"Ошибка загрузки индекса спама: {task.exception()!r}")
+
+
 async def main():
     # Подключаемся к базе данных
     await db.connect()
     print("Подключение к базе данных установлено")
+    moderation_prune_task = None
+    if MODERATION_CACHE_DB:
+        moderation_cache.attach_store(db)
+        # Устаревшие вердикты удаляются из таблицы раз в TTL
+        moderation_prune_task = asyncio.create_task(
+            moderation_cache.prune_periodically(moderation_cache.ttl))
+
+    # Индекс спама загружается в фоне, чтобы не задерживать запуск
+    spam_index_task = None
+    if SPAM_INDEX_ENABLED:
+        db.spam_index = spam_index
+        spam_index_task = asyncio.create_task(spam_index.load(db))
+        spam_index_task.add_done_callback(log_spam_index_load)
+    if AVATAR_INDEX_ENABLED:
+        db.avatar_index = avatar_index
+        await avatar_index.load(db)
+
+    if PRECLASSIFIER_MODEL:
+        global preclassifier
+        try:
+            preclassifier = PreClassifier.load(
+                PRECLASSIFIER_MODEL,
+                float(PRECLASSIFIER_NEGATIVE) if PRECLASSIFIER_NEGATIVE else None,
+                float(PRECLASSIFIER_POSITIVE) if PRECLASSIFIER_POSITIVE else None
+            )
+            print(f"Предклассификатор загружен: {preclassifier.stats()}")
+        except Exception as e:
+            print(f"Не удалось загрузить предклассификатор {PRECLASSIFIER_MODEL}: {e}")
+
+    # Запускаем конвейер обработки сообщений
+    await pipeline.start()
 
     # Запускаем клиенты
     await user_client.start()
     await bot_client.start()
 
+    # Индекс участников строится и обновляется в фоне
+    participants_task = asyncio.create_task(participant_index.refresh_periodically(
+        [chat_id for chat_id in ALLOWED_CHAT_IDS if chat_id], PARTICIPANTS_REFRESH_INTERVAL))
+
+    stats_task = None
+    if STATS_LOG_INTERVAL > 0:
+        stats_task = asyncio.create_task(log_stats_periodically())
+
+    # docker stop шлёт SIGTERM процессу с PID 1: без обработчика он завершится по
+    # SIGKILL, не дообработав конвейер и не сбросив буфер отложенной записи
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    clients_task = asyncio.gather(
+        user_client.run_until_disconnected(),  # Держим user_client активным
+        bot_client.run_until_disconnected()   # Держим bot_client активным
+    )
+    stop_task = asyncio.create_task(stop_event.wait())
     try:
-        await asyncio.gather(
-            user_client.run_until_disconnected(),  # Держим user_client активным
-            bot_client.run_until_disconnected()   # Держим bot_client активным
-        )
+        await asyncio.wait([clients_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+        if stop_event.is_set():
+            print("Получен сигнал остановки, завершаем работу")
     finally:
+        stop_task.cancel()
+        participants_task.cancel()
+        if spam_index_task:
+            spam_index_task.cancel()
+        if moderation_prune_task:
+            moderation_prune_task.cancel()
+        if stats_task:
+            stats_task.cancel()
+        # Дообрабатываем сообщения, уже попавшие в конвейер
+        await pipeline.stop()
         # Закрываем соединение с базой данных
         await db.close()
         print("Соединение с базой данных закрыто")
+        # Закрываем пул соединений LLM
+        await close_llm_client()
+        # Клиенты отключаем последними: конвейер мог ещё отправлять уведомления
+        await user_client.disconnect()
+        await bot_client.disconnect()
+        await asyncio.gather(clients_task, return_exceptions=True)
 
 if __name__ == '__main__':
     import asyncio
@@ -0,0 +1,70 @@
+from collections import deque
+
+
+def sender_display_name(sender):
+    """Имя отправителя для контекста: название канала/группы или username пользователя"""
+    if sender:
+        if hasattr(sender, 'title') and sender.title:  # для каналов/групп
+            return sender.title
+        elif hasattr(sender, 'username') and sender.username:  # для пользователей
+            return sender.username
+    return None
+
+
+class MessageStore:
+    """
+    Недавние сообщения чатов в памяти: кольцевой буфер id и словарь id -> сообщение
+    на каждый чат. Позволяет восстанавливать цепочки ответов без запросов к Telegram.
+    """
+
+    def __init__(self, max_per_chat=1000):
+        self.max_per_chat = max_per_chat
+        self._chats = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, chat_id, message_id, text, sender_id, sender_name, reply_to_id=None):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = (deque(), {})
+        order, messages = chat
+        if message_id not in messages:
+            order.append(message_id)
+            if len(order) > self.max_per_chat:
+                messages.pop(order.popleft(), None)
+        messages[message_id] = {
+            'text': text,
+            'sender_id': sender_id,
+            'sender_name': sender_name,
+            'reply_to_id': reply_to_id,
+        }
+
+    def add_message(self, chat_id, message, sender=None):
+        """Сохраняет сообщение Telethon; sender передаётся, если уже известен"""
+        self.add(
+            chat_id,
+            message.id,
+            message.text,
+            message.sender_id,
+            sender_display_name(sender),
+            message.reply_to_msg_id if message.reply_to else None
+        )
+
+    def get(self, chat_id, message_id):
+        chat = self._chats.get(chat_id)
+        entry = chat[1].get(message_id) if chat else None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "chats": len(self._chats),
+            "messages": sum(len(order) for order, _ in self._chats.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
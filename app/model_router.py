@@ -0,0 +1,239 @@
+import time
+import asyncio
+
+
+class ModelStats:
+    """Статистика модели: EWMA задержки и доли ошибок, состояние circuit breaker"""
+
+    def __init__(self, name, alpha):
+        self.name = name
+        self.alpha = alpha
+        self.ewma_latency = None
+        self.ewma_error_rate = 0.0
+        self.consecutive_failures = 0
+        self.state = "closed"  # closed / open / half_open
+        self.opened_at = None
+        self.probe_in_flight = False
+        # Счётчики для метрик
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.skipped = 0
+        self.breaker_trips = 0
+
+    def record_success(self, latency):
+        self.requests += 1
+        self.successes += 1
+        self.consecutive_failures = 0
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = self.alpha * latency + (1 - self.alpha) * self.ewma_latency
+        self.ewma_error_rate = (1 - self.alpha) * self.ewma_error_rate
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.ewma_error_rate = self.alpha + (1 - self.alpha) * self.ewma_error_rate
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "ewma_latency": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+            "ewma_error_rate": round(self.ewma_error_rate, 3),
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "skipped": self.skipped,
+            "breaker_trips": self.breaker_trips,
+        }
+
+
+class ModelRouter:
+    """
+    Маршрутизатор запросов по списку моделей:
+    - останавливается на первом валидном ответе;
+    - при превышении порога задержки отправляет хеджированный запрос следующей модели;
+    - пропускает модели с открытым circuit breaker.
+    """
+
+    def __init__(
+        self,
+        models,
+        call,
+        validate=None,
+        hedge_after=0.0,
+        failure_threshold=3,
+        error_rate_threshold=0.8,
+        min_requests=5,
+        cooldown=60.0,
+        alpha=0.2
+    ):
+        self.models = list(models)
+        self.call = call
+        self.validate = validate
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.stats = {name: ModelStats(name, alpha) for name in self.models}
+        self.counters = {
+            "routed": 0,
+            "first_choice": 0,
+            "fallback": 0,
+            "hedges_sent": 0,
+            "hedges_won": 0,
+            "all_failed": 0,
+        }
+
+    def _is_available(self, stats):
+        """
+        Проверяет, можно ли отправить запрос модели с учётом circuit breaker.
+        В полуоткрытом состоянии пропускает только одного вызывающего и сразу
+        занимает пробную попытку — освобождает её _attempt или route.
+        """
+        if stats.state == "closed":
+            return True
+        if stats.state == "open":
+            if time.monotonic() - stats.opened_at < self.cooldown:
+                return False
+            # Таймаут истёк — пропускаем одну пробную попытку
+            stats.state = "half_open"
+        if stats.probe_in_flight:
+            return False
+        stats.probe_in_flight = True
+        return True
+
+    def _trip(self, stats):
+        stats.state = "open"
+        stats.opened_at = time.monotonic()
+        stats.breaker_trips += 1
+        print(f"Circuit breaker открыт для модели {stats.name}")
+
+    def _on_success(self, stats, latency):
+        stats.record_success(latency)
+        if stats.state != "closed":
+            print(f"Circuit breaker закрыт для модели {stats.name}")
+        stats.state = "closed"
+
+    def _on_failure(self, stats):
+        stats.record_failure()
+        if stats.state == "half_open":
+            self._trip(stats)
+        elif stats.state == "closed":
+            too_many_failures = stats.consecutive_failures >= self.failure_threshold
+            too_many_errors = (
+                stats.requests >= self.min_requests
+                and stats.ewma_error_rate >= self.error_rate_threshold
+            )
+            if too_many_failures or too_many_errors:
+                self._trip(stats)
+
+    def _candidates(self):
+        """Возвращает (модели по порядку, модели, для которых занята пробная попытка)"""
+        candidates = []
+        probes = set()
+        for name in self.models:
+            stats = self.stats[name]
+            probing = stats.probe_in_flight
+            if self._is_available(stats):
+                candidates.append(name)
+                if stats.probe_in_flight and not probing:
+                    probes.add(name)
+            else:
+                stats.skipped += 1
+        if candidates:
+            return candidates, probes
+        # Если все модели отключены — всё равно пробуем их по порядку,
+        # не трогая модели, которые сейчас проходят пробную попытку
+        return [
+            name for name in self.models if not self.stats[name].probe_in_flight
+        ] or list(self.models), probes
+
+    async def _attempt(self, model_name, messages, is_probe=False):
+        stats = self.stats[model_name]
+        started = time.monotonic()
+        try:
+            completion = await self.call(model_name, messages)
+            response = completion.choices[0].message.content
+            if self.validate and not self.validate(response):
+                raise ValueError(f"невалидный ответ: {response!r}")
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            raise
+        except Exception as e:
+            print(f"Ошибка при обращении к OpenAI API модель {model_name}: {e}")
+            self._on_failure(stats)
+            return None
+        finally:
+            if is_probe:
+                stats.probe_in_flight = False
+        self._on_success(stats, time.monotonic() - started)
+        return response
+
+    async def route(self, messages):
+        """Возвращает первый валидный ответ одной из моделей или None"""
+        self.counters["routed"] += 1
+        candidates, probes = self._candidates()
+        pending = {}
+        next_index = 0
+
+        def launch(hedged=False):
+            nonlocal next_index
+            name = candidates[next_index]
+            task = asyncio.ensure_future(self._attempt(name, messages, is_probe=name in probes))
+            pending[task] = (next_index, hedged)
+            next_index += 1
+
+        launch()
+        try:
+            while pending:
+                can_hedge = self.hedge_after > 0 and next_index < len(candidates)
+                done, _ = await asyncio.wait(
+                    pending.keys(),
+                    timeout=self.hedge_after if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Порог задержки превышен — хеджируем следующей моделью
+                    self.counters["hedges_sent"] += 1
+                    launch(hedged=True)
+                    continue
+
+                for task in done:
+                    index, hedged = pending.pop(task)
+                    response = task.result()
+                    if response is None:
+                        continue
+                    if index == 0:
+                        self.counters["first_choice"] += 1
+                    elif hedged:
+                        self.counters["hedges_won"] += 1
+                    else:
+                        self.counters["fallback"] += 1
+                    return response
+
+                # Все завершившиеся попытки неудачны — сразу пробуем следующую модель
+                if not pending and next_index < len(candidates):
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+            # Пробные попытки моделей, до которых очередь не дошла, освобождаем
+            for name in candidates[next_index:]:
+                if name in probes:
+                    self.stats[name].probe_in_flight = False
+
+        self.counters["all_failed"] += 1
+        return None
+
+    def metrics(self):
+        """Метрики маршрутизации для подбора порогов"""
+        return {
+            "router": dict(self.counters),
+            "models": {name: stats.as_dict() for name, stats in self.stats.items()},
+        }
@@ -0,0 +1,65 @@
+import asyncio
+
+
+class MicroBatcher:
+    """
+    Собирает элементы с одним ключом (например, сообщения одного чата), пришедшие
+    в течение window секунд или до max_size штук, и обрабатывает их одним вызовом
+    process(items) -> [результат для каждого элемента]. Каждый отправитель получает
+    свой результат (или исключение пакета).
+    """
+
+    def __init__(self, process, window=0.3, max_size=8):
+        self.process = process
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, key, item):
+        """Добавляет элемент в текущий пакет ключа и ждёт результата"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((item, future))
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.process([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "pending": sum(len(batch) for batch in self._pending.values()),
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+        }
@@ -0,0 +1,134 @@
+import asyncio
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.channels import GetParticipantsRequest, GetParticipantRequest
+from telethon.tl.types import Channel, ChannelParticipantsSearch, User
+
+
+class ParticipantIndex:
+    """
+    Индекс участников чатов: chat_id -> {user_id: User}.
+    Строится один раз при запуске, пополняется из событий и периодически
+    перестраивается в фоне; промах дополняется точечным GetParticipantRequest.
+    """
+
+    def __init__(self, client, page_size=200, page_delay=0.5):
+        self.client = client
+        self.page_size = page_size
+        self.page_delay = page_delay
+        self._chats = {}
+        # Изменения из событий, пришедшие во время перестройки: chat_id -> {user_id: User или None}
+        self._pending_changes = {}
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.rebuilds = 0
+
+    def get(self, chat_id, user_id):
+        users = self._chats.get(chat_id)
+        return users.get(user_id) if users else None
+
+    def add(self, chat_id, user):
+        if isinstance(user, User):
+            self._chats.setdefault(chat_id, {})[user.id] = user
+            changes = self._pending_changes.get(chat_id)
+            if changes is not None:
+                changes[user.id] = user
+
+    def remove(self, chat_id, user_id):
+        users = self._chats.get(chat_id)
+        if users:
+            users.pop(user_id, None)
+        changes = self._pending_changes.get(chat_id)
+        if changes is not None:
+            changes[user_id] = None
+
+    async def lookup(self, chat, chat_id, user_id):
+        """Ищет участника в индексе, при промахе — запросом к Telegram"""
+        user = self.get(chat_id, user_id)
+        if user is not None:
+            self.hits += 1
+            return user
+        self.misses += 1
+        if not isinstance(chat, Channel):
+            return None
+        try:
+            result = await self.client(GetParticipantRequest(channel=chat, participant=user_id))
+        except Exception as e:
+            print(f"Ошибка при получении участника {user_id}: {e}")
+            return None
+        user = next((u for u in result.users if u.id == user_id), None)
+        if user is not None:
+            self.fetched += 1
+            self.add(chat_id, user)
+        return user
+
+    async def _fetch_all(self, chat):
+        users = {}
+        offset = 0
+        while True:
+            try:
+                participants = await self.client(GetParticipantsRequest(
+                    channel=chat,
+                    filter=ChannelParticipantsSearch(""),
+                    offset=offset,
+                    limit=self.page_size,
+                    hash=0
+                ))
+            except FloodWaitError as e:
+                print(f"FloodWait при загрузке участников, ждём {e.seconds} с")
+                await asyncio.sleep(e.seconds)
+                continue
+            if not participants.users:
+                break
+            for user in participants.users:
+                users[user.id] = user
+            offset += len(participants.users)
+            await asyncio.sleep(self.page_delay)
+        return users
+
+    async def build(self, chat_id):
+        """Загружает всех участников чата и заменяет ими запись индекса"""
+        try:
+            chat = await self.client.get_entity(chat_id)
+        except Exception as e:
+            print(f"Не удалось получить чат {chat_id} для индекса участников: {e}")
+            return
+        if not isinstance(chat, Channel):
+            return
+        # Индекс заменяется свежим списком целиком (обновлённые имена, ушедшие участники);
+        # поверх него применяются только события, пришедшие во время загрузки
+        changes = self._pending_changes[chat_id] = {}
+        try:
+            users = await self._fetch_all(chat)
+        except Exception as e:
+            print(f"Ошибка при загрузке участников чата {chat_id}: {e}")
+            return
+        finally:
+            self._pending_changes.pop(chat_id, None)
+        for user_id, user in changes.items():
+            if user is None:
+                users.pop(user_id, None)
+            else:
+                users[user_id] = user
+        self._chats[chat_id] = users
+        self.rebuilds += 1
+        print(f"Индекс участников чата {chat_id}: {len(users)} пользователей")
+
+    async def refresh_periodically(self, chat_ids, interval):
+        """Строит индекс для чатов и перестраивает его каждые interval секунд"""
+        while True:
+            for chat_id in chat_ids:
+                await self.build(chat_id)
+            if interval <= 0:
+                return
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "users": sum(len(users) for users in self._chats.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetched": self.fetched,
+            "rebuilds": self.rebuilds,
+        }
@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+
+
+class Stage:
+    """Этап конвейера: корутина-обработчик и число воркеров"""
+
+    def __init__(self, name, handler, workers=1):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+
+
+class Pipeline:
+    """
+    Конвейер обработки сообщений с ограниченными очередями между этапами.
+
+    - submit() ждёт, пока во входной очереди появится место (backpressure);
+    - каждый этап обрабатывается своим пулом воркеров;
+    - обработчик этапа возвращает элемент для следующего этапа или None, чтобы
+      завершить обработку;
+    - перед последним этапом элементы одного чата выстраиваются в порядке
+      поступления, и последний этап выполняется для чата строго по очереди.
+    """
+
+    def __init__(self, stages, queue_size=100, key=None, on_finish=None):
+        if not stages:
+            raise ValueError("Конвейеру нужен хотя бы один этап")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.key = key or (lambda item: None)
+        self.on_finish = on_finish
+        # Очереди для всех этапов, кроме последнего
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in stages[:-1]]
+        # Последний этап: по очереди на воркер, чат всегда попадает в одну и ту же
+        final = stages[-1]
+        self._final_queues = [asyncio.Queue(maxsize=queue_size) for _ in range(final.workers)]
+        self._next_seq = {}
+        self._release_seq = {}
+        self._reorder = {}
+        self._release_lock = asyncio.Lock()
+        self._tasks = []
+        self.submitted = 0
+        self.completed = 0
+
+    async def start(self):
+        for index, stage in enumerate(self.stages[:-1]):
+            for _ in range(stage.workers):
+                self._tasks.append(asyncio.create_task(self._stage_worker(index)))
+        for queue in self._final_queues:
+            self._tasks.append(asyncio.create_task(self._final_worker(queue)))
+
+    async def stop(self, drain=True):
+        """Останавливает воркеры; при drain=True сначала дожидается пустых очередей"""
+        if drain:
+            for queue in self._queues + self._final_queues:
+                await queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, item):
+        """Ставит элемент в конвейер, ожидая места во входной очереди"""
+        chat_key = self.key(item)
+        seq_counter = self._next_seq.get(chat_key)
+        if seq_counter is None:
+            seq_counter = self._next_seq[chat_key] = itertools.count()
+            self._release_seq[chat_key] = 0
+            self._reorder[chat_key] = {}
+        envelope = (chat_key, next(seq_counter), item)
+        self.submitted += 1
+        if self._queues:
+            await self._queues[0].put(envelope)
+        else:
+            await self._release(envelope)
+
+    async def _run_stage(self, stage, item, final=False):
+        try:
+            result = await stage.handler(item)
+        except Exception as e:
+            stage.errors += 1
+            print(f"Ошибка на этапе {stage.name}: {e}")
+            return None
+        if result is None and not final:
+            stage.dropped += 1
+        else:
+            stage.processed += 1
+        return result
+
+    async def _stage_worker(self, index):
+        stage = self.stages[index]
+        queue = self._queues[index]
+        while True:
+            chat_key, seq, item = await queue.get()
+            try:
+                result = await self._run_stage(stage, item)
+                if result is None:
+                    await self._release((chat_key, seq, None))
+                    self._finish(item)
+                elif index + 1 < len(self._queues):
+                    await self._queues[index + 1].put((chat_key, seq, result))
+                else:
+                    await self._release((chat_key, seq, result))
+            finally:
+                queue.task_done()
+
+    async def _release(self, envelope):
+        """Передаёт элементы чата последнему этапу в порядке поступления"""
+        chat_key, seq, item = envelope
+        async with self._release_lock:
+            pending = self._reorder[chat_key]
+            pending[seq] = item
+            while self._release_seq[chat_key] in pending:
+                ready = pending.pop(self._release_seq[chat_key])
+                self._release_seq[chat_key] += 1
+                if ready is not None:
+                    shard = hash(chat_key) % len(self._final_queues)
+                    await self._final_queues[shard].put(ready)
+
+    async def _final_worker(self, queue):
+        stage = self.stages[-1]
+        while True:
+            item = await queue.get()
+            try:
+                await self._run_stage(stage, item, final=True)
+                self._finish(item)
+            finally:
+                queue.task_done()
+
+    def _finish(self, item):
+        self.completed += 1
+        if self.on_finish:
+            try:
+                self.on_finish(item)
+            except Exception as e:
+                print(f"Ошибка при завершении обработки: {e}")
+
+    def stats(self):
+        """Глубина очередей и счётчики этапов"""
+        depths = [queue.qsize() for queue in self._queues]
+        depths.append(sum(queue.qsize() for queue in self._final_queues))
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "in_flight": self.submitted - self.completed,
+            "stages": {
+                stage.name: {
+                    "queue": depth,
+                    "workers": stage.workers,
+                    "processed": stage.processed,
+                    "dropped": stage.dropped,
+                    "errors": stage.errors,
+                }
+                for stage, depth in zip(self.stages, depths)
+            },
+        }
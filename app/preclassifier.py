@@ -0,0 +1,377 @@
+"""
+Локальный предклассификатор аккаунтов: логистическая регрессия на хешированных
+n-граммах (NumPy). Обучается офлайн на вердиктах LLM из таблицы users; в рантайме
+однозначные случаи решаются без LLM, в LLM уходит только неуверенная середина.
+
+Обучение и отчёт (из каталога app/):
+    python preclassifier.py train [--out models/preclassifier-<дата>.npz]
+    python preclassifier.py report --model models/preclassifier-<дата>.npz
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+from verdict_cache import normalize_text
+
+# Версия формата модели и признаков; модель другой версии не загружается
+MODEL_FORMAT_VERSION = 1
+# Префикс пояснения вердиктов классификатора — такие вердикты не используются для обучения
+THOUGHTS_PREFIX = "Локальный классификатор"
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _own_text(message):
+    """Из строки истории «Контекст: ... Сообщение: ...» оставляет текст самого пользователя"""
+    return message.split("Сообщение:", 1)[-1]
+
+
+def extract_features(account_json, dim):
+    """
+    Переводит аккаунт в разреженный вектор: (индексы, значения) хешированных слов,
+    биграмм слов, символьных 4-грамм и нескольких мета-признаков. Вектор L2-нормирован.
+    """
+    counts = {}
+
+    def add(feature):
+        index = zlib.crc32(feature.encode("utf-8")) % dim
+        counts[index] = counts.get(index, 0) + 1
+
+    channel = account_json.get("personal_channel") or {}
+    messages = account_json.get("messages") or []
+    posts = channel.get("posts") or []
+    fields = [
+        ("name", account_json.get("full_name")),
+        ("name", account_json.get("username")),
+        ("chan", channel.get("title")),
+        *(("msg", _own_text(message)) for message in messages),
+        *(("post", post.get("text")) for post in posts),
+    ]
+    for field, text in fields:
+        if not text:
+            continue
+        text = normalize_text(text)
+        words = _WORD_RE.findall(text)
+        if not words:
+            add(f"{field}:no_words")
+        for word in words:
+            add(f"{field}:w:{word}")
+        for first, second in zip(words, words[1:]):
+            add(f"{field}:b:{first} {second}")
+        for i in range(len(text) - 3):
+            add(f"{field}:c:{text[i:i + 4]}")
+
+    add(f"meta:messages:{min(len(messages), 5)}")
+    add(f"meta:channel:{bool(channel)}")
+    add(f"meta:posts:{min(len(posts), 3)}")
+
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    norm = np.linalg.norm(values)
+    if norm:
+        values /= norm
+    return indices, values
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+class PreClassifier:
+    """Обученная модель: веса хешированных признаков, смещение и пороги"""
+
+    def __init__(self, weights, bias, negative_threshold, positive_threshold, meta=None):
+        self.weights = weights
+        self.bias = bias
+        self.dim = len(weights)
+        self.negative_threshold = negative_threshold
+        self.positive_threshold = positive_threshold
+        self.meta = meta or {}
+        self.scored = 0
+        self.settled_bots = 0
+        self.settled_humans = 0
+
+    @classmethod
+    def load(cls, path, negative_threshold=None, positive_threshold=None):
+        """Загружает модель; пороги из аргументов переопределяют сохранённые в модели"""
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("format_version") != MODEL_FORMAT_VERSION:
+                raise ValueError(
+                    f"Версия модели {meta.get('format_version')} не поддерживается "
+                    f"(ожидается {MODEL_FORMAT_VERSION})")
+            weights = data["weights"].astype(np.float32)
+            bias = float(data["bias"])
+        return cls(
+            weights,
+            bias,
+            meta["negative_threshold"] if negative_threshold is None else negative_threshold,
+            meta["positive_threshold"] if positive_threshold is None else positive_threshold,
+            meta
+        )
+
+    def save(self, path):
+        meta = dict(self.meta)
+        meta.update({
+            "format_version": MODEL_FORMAT_VERSION,
+            "dim": self.dim,
+            "negative_threshold": self.negative_threshold,
+            "positive_threshold": self.positive_threshold,
+        })
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(
+            path,
+            weights=self.weights.astype(np.float32),
+            bias=np.float32(self.bias),
+            meta=np.array(json.dumps(meta, ensure_ascii=False))
+        )
+
+    def score_features(self, indices, values):
+        return float(_sigmoid(self.bias + float(np.dot(self.weights[indices], values))))
+
+    def score(self, account_json):
+        """Вероятность того, что аккаунт — спам-бот"""
+        self.scored += 1
+        return self.score_features(*extract_features(account_json, self.dim))
+
+    def verdict(self, account_json):
+        """
+        Возвращает вердикт JSON для однозначных случаев (в формате ответа LLM)
+        или None, если аккаунт нужно отправить в LLM.
+        """
+        score = self.score(account_json)
+        if score >= self.positive_threshold:
+            self.settled_bots += 1
+            is_bot, confidence = True, score
+        elif score <= self.negative_threshold:
+            self.settled_humans += 1
+            is_bot, confidence = False, 1 - score
+        else:
+            return None
+        return json.dumps({
+            "thoughts": f"{THOUGHTS_PREFIX}: вероятность спам-бота {score:.2f}",
+            "is_bot": is_bot,
+            "confidence": round(confidence, 2)
+        }, ensure_ascii=False)
+
+    def stats(self):
+        return {
+            "version": self.meta.get("trained_at"),
+            "scored": self.scored,
+            "settled_bots": self.settled_bots,
+            "settled_humans": self.settled_humans,
+            "thresholds": [self.negative_threshold, self.positive_threshold],
+        }
+
+
+def train_logistic(samples, labels, dim, epochs=8, learning_rate=0.5, l2=1e-6, seed=42):
+    """
+    Обучает логистическую регрессию SGD по разреженным примерам (индексы, значения).
+    Классы взвешиваются обратно их частоте.
+    """
+    labels = np.asarray(labels, dtype=np.float32)
+    positives = max(float(labels.sum()), 1.0)
+    negatives = max(float(len(labels) - labels.sum()), 1.0)
+    class_weight = {1.0: len(labels) / (2 * positives), 0.0: len(labels) / (2 * negatives)}
+
+    weights = np.zeros(dim, dtype=np.float32)
+    bias = 0.0
+    rng = np.random.default_rng(seed)
+    for epoch in range(epochs):
+        rate = learning_rate / np.sqrt(1 + epoch)
+        for i in rng.permutation(len(samples)):
+            indices, values = samples[i]
+            z = bias + float(np.dot(weights[indices], values))
+            gradient = (float(_sigmoid(z)) - labels[i]) * class_weight[float(labels[i])]
+            weights[indices] -= rate * (gradient * values + l2 * weights[indices])
+            bias -= rate * gradient
+    return weights, bias
+
+
+def evaluate(scores, labels, negative_threshold, positive_threshold):
+    """Точность/полнота решений классификатора на отложенной выборке"""
+    scores = np.asarray(scores)
+    labels = np.asarray(labels, dtype=bool)
+    flagged = scores >= positive_threshold
+    cleared = scores <= negative_threshold
+    true_bots = int((flagged & labels).sum())
+    true_humans = int((cleared & ~labels).sum())
+    total = len(labels)
+
+    def ratio(a, b):
+        return round(a / b, 4) if b else None
+
+    return {
+        "samples": total,
+        "bots": int(labels.sum()),
+        "bot_precision": ratio(true_bots, int(flagged.sum())),
+        "bot_recall": ratio(true_bots, int(labels.sum())),
+        "human_precision": ratio(true_humans, int(cleared.sum())),
+        "human_recall": ratio(true_humans, int((~labels).sum())),
+        "settled_share": ratio(int((flagged | cleared).sum()), total),
+        "thresholds": [negative_threshold, positive_threshold],
+    }
+
+
+def choose_thresholds(scores, labels, target_precision=0.98, min_support=20, min_band=0.2):
+    """
+    Подбирает пороги на калибровочной выборке: самый низкий положительный и самый
+    высокий отрицательный, при которых точность решений не ниже target_precision.
+    Пороги ставятся только между различными значениями скора, поэтому одинаковые
+    скоры всегда попадают по одну сторону порога. Полоса шириной min_band вокруг 0.5
+    всегда остаётся неуверенной и уходит в LLM. Если подходящего порога нет —
+    соответствующая сторона не решается локально.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    values, inverse = np.unique(scores, return_inverse=True)
+    totals = np.bincount(inverse, minlength=len(values))
+    bots = np.bincount(inverse, weights=labels, minlength=len(values))
+
+    positive_threshold = 1.01
+    lower_bound = 0.5 + min_band / 2
+    # Для каждого различного значения: сколько скоров не ниже него и сколько среди них ботов
+    flagged = np.cumsum(totals[::-1])[::-1]
+    flagged_bots = np.cumsum(bots[::-1])[::-1]
+    for i in range(len(values)):
+        if values[i] < lower_bound or flagged[i] < min_support:
+            continue
+        if flagged_bots[i] / flagged[i] >= target_precision:
+            below = values[i - 1] if i else -0.01
+            positive_threshold = float(max((below + values[i]) / 2, lower_bound))
+            break
+
+    negative_threshold = -0.01
+    upper_bound = 0.5 - min_band / 2
+    cleared = np.cumsum(totals)
+    cleared_humans = cleared - np.cumsum(bots)
+    for i in range(len(values) - 1, -1, -1):
+        if values[i] > upper_bound or cleared[i] < min_support:
+            continue
+        if cleared_humans[i] / cleared[i] >= target_precision:
+            above = values[i + 1] if i + 1 < len(values) else 1.01
+            negative_threshold = float(min((values[i] + above) / 2, upper_bound))
+            break
+    return negative_threshold, positive_threshold
+
+
+def _split_part(user_id, holdout_share, calibration_share):
+    # Детерминированное разбиение: пользователь всегда попадает в одну и ту же часть
+    bucket = zlib.crc32(str(user_id).encode()) % 1000
+    if bucket < holdout_share * 1000:
+        return "holdout"
+    if bucket < (holdout_share + calibration_share) * 1000:
+        return "calibration"
+    return "train"
+
+
+async def _load_dataset(db, dim, min_confidence, holdout_share, calibration_share):
+    """
+    Возвращает обучающую, калибровочную (для подбора порогов) и отложенную
+    (для отчёта) выборки: {часть: ([признаки], [метки])}
+    """
+    parts = {"train": ([], []), "calibration": ([], []), "holdout": ([], [])}
+    async for user_id, is_bot, account_json in db.iter_labeled_accounts(
+            min_confidence=min_confidence, exclude_thoughts_prefix=THOUGHTS_PREFIX):
+        target = parts[_split_part(user_id, holdout_share, calibration_share)]
+        target[0].append(extract_features(account_json, dim))
+        target[1].append(1.0 if is_bot else 0.0)
+    return parts
+
+
+async def run_train(args):
+    from database import db
+
+    await db.connect()
+    try:
+        parts = await _load_dataset(
+            db, args.dim, args.min_confidence, args.holdout, args.calibration)
+    finally:
+        await db.close()
+    train, calibration, holdout = parts["train"], parts["calibration"], parts["holdout"]
+    print(f"Обучающая выборка: {len(train[1])}, калибровочная: {len(calibration[1])}, "
+          f"отложенная: {len(holdout[1])}, ботов в обучающей: {int(sum(train[1]))}")
+    if not train[1] or not calibration[1] or not holdout[1]:
+        print("Недостаточно размеченных аккаунтов для обучения")
+        return
+
+    weights, bias = train_logistic(train[0], train[1], args.dim, epochs=args.epochs)
+    model = PreClassifier(weights, bias, 0.0, 1.0, {
+        "trained_at": datetime.utcnow().strftime("%Y%m%d-%H%M%S"),
+        "train_samples": len(train[1]),
+        "calibration_samples": len(calibration[1]),
+        "holdout_samples": len(holdout[1]),
+        "min_confidence": args.min_confidence,
+        "holdout_share": args.holdout,
+        "calibration_share": args.calibration,
+    })
+    # Пороги подбираются на калибровочной выборке, отчёт — на отложенной, которую модель не видела
+    scores = [model.score_features(*features) for features in calibration[0]]
+    model.negative_threshold, model.positive_threshold = choose_thresholds(
+        scores, calibration[1], target_precision=args.target_precision, min_band=args.min_band)
+    scores = [model.score_features(*features) for features in holdout[0]]
+    report = evaluate(scores, holdout[1], model.negative_threshold, model.positive_threshold)
+    model.meta["holdout_report"] = report
+
+    out = args.out or os.path.join("models", f"preclassifier-{model.meta['trained_at']}.npz")
+    model.save(out)
+    print(f"Модель сохранена: {out}")
+    print(f"Отчёт на отложенной выборке: {json.dumps(report, ensure_ascii=False)}")
+
+
+async def run_report(args):
+    from database import db
+
+    model = PreClassifier.load(args.model, args.negative_threshold, args.positive_threshold)
+    await db.connect()
+    try:
+        # Разбиение детерминировано: берём ту же отложенную долю, что при обучении
+        parts = await _load_dataset(
+            db, model.dim, args.min_confidence,
+            model.meta.get("holdout_share", args.holdout),
+            model.meta.get("calibration_share", args.calibration))
+    finally:
+        await db.close()
+    holdout = parts["holdout"]
+    scores = [model.score_features(*features) for features in holdout[0]]
+    report = evaluate(scores, holdout[1], model.negative_threshold, model.positive_threshold)
+    print(f"Отчёт на отложенной выборке: {json.dumps(report, ensure_ascii=False)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный предклассификатор аккаунтов")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("train", help="обучить модель на вердиктах из БД")
+    train.add_argument("--out", help="файл модели (по умолчанию models/preclassifier-<дата>.npz)")
+    train.add_argument("--dim", type=int, default=1 << 18, help="размер хешированного пространства")
+    train.add_argument("--epochs", type=int, default=8)
+    train.add_argument("--target-precision", type=float, default=0.98,
+                       help="требуемая точность локальных решений для подбора порогов")
+    train.add_argument("--min-band", type=float, default=0.2,
+                       help="ширина неуверенной полосы вокруг 0.5, которая всегда уходит в LLM")
+
+    report = commands.add_parser("report", help="точность и полнота модели на отложенной выборке")
+    report.add_argument("--model", required=True)
+    report.add_argument("--negative-threshold", type=float)
+    report.add_argument("--positive-threshold", type=float)
+
+    for command in (train, report):
+        command.add_argument("--min-confidence", type=float, default=0.7,
+                             help="минимальная уверенность LLM для использования метки")
+        command.add_argument("--holdout", type=float, default=0.2, help="доля отложенной выборки")
+        command.add_argument("--calibration", type=float, default=0.2,
+                             help="доля калибровочной выборки для подбора порогов")
+
+    args = parser.parse_args()
+    asyncio.run(run_train(args) if args.command == "train" else run_report(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одним ключом: выполняется только первый
+    вызов, остальные дожидаются его результата (или исключения).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.joined = 0
+
+    async def do(self, key, func):
+        """Возвращает (результат, shared); shared=True — результат чужого вызова"""
+        future = self._calls.get(key)
+        if future is not None:
+            self.joined += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        # Исключение лидера считаем обработанным, даже если никто не ждал
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        self.leaders += 1
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "joined": self.joined,
+        }
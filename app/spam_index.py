@@ -0,0 +1,142 @@
+import asyncio
+import json
+import random
+from verdict_cache import normalize_text
+
+_MASK = (1 << 64) - 1
+
+
+class SpamIndex:
+    """
+    LSH-индекс (MinHash) по текстам сообщений пользователей.
+    Находит почти дословные копии сообщений аккаунтов, уже помеченных как боты.
+
+    Для каждого текста считается MinHash-подпись по символьным шинглам, подпись
+    режется на полосы (bands), и каждая полоса — ключ в словаре бакетов. Поиск —
+    это bands обращений к словарю, поэтому он не зависит от размера корпуса.
+    """
+
+    def __init__(self, num_perm=16, bands=4, shingle_size=4, min_text_length=20,
+                 min_band_matches=2, min_bot_users=2, seed=42):
+        if num_perm % bands:
+            raise ValueError("num_perm должен делиться на bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_text_length = min_text_length
+        self.min_band_matches = min_band_matches
+        self.min_bot_users = min_bot_users
+        # Перестановки задаются XOR-масками поверх hash() шинглов — это дешевле
+        # классического (a * x + b) mod p и держит поиск в пределах долей миллисекунды
+        rng = random.Random(seed)
+        self._masks = [rng.getrandbits(64) for _ in range(num_perm)]
+        self._buckets = {}
+        self.bot_user_ids = set()
+        self.entries = 0
+        self.lookups = 0
+        self.matches = 0
+
+    def _shingles(self, text):
+        size = self.shingle_size
+        if len(text) <= size:
+            return {hash(text) & _MASK}
+        return {hash(text[i:i + size]) & _MASK for i in range(len(text) - size + 1)}
+
+    def _band_keys(self, text):
+        text = normalize_text(text)
+        if len(text) < self.min_text_length:
+            return None
+        shingles = self._shingles(text)
+        signature = [min([h ^ mask for h in shingles]) for mask in self._masks]
+        rows = self.rows
+        return [
+            (band, hash(tuple(signature[band * rows:(band + 1) * rows])))
+            for band in range(self.bands)
+        ]
+
+    def add(self, user_id, text):
+        """Добавляет текст сообщения пользователя в индекс"""
+        self._add_keys(user_id, self._band_keys(text))
+
+    def _add_keys(self, user_id, keys):
+        if not keys:
+            return
+        for key in keys:
+            users = self._buckets.get(key)
+            if users is None:
+                self._buckets[key] = {user_id}
+            else:
+                users.add(user_id)
+        self.entries += 1
+
+    def set_label(self, user_id, is_bot):
+        """Обновляет метку пользователя (бот / не бот)"""
+        if is_bot:
+            self.bot_user_ids.add(user_id)
+        else:
+            self.bot_user_ids.discard(user_id)
+
+    def find_bot_neighbours(self, text, exclude_user_id=None):
+        """Возвращает id ботов, писавших почти такой же текст"""
+        self.lookups += 1
+        keys = self._band_keys(text)
+        if not keys:
+            return set()
+        band_matches = {}
+        for key in keys:
+            for user_id in self._buckets.get(key, ()):
+                if user_id != exclude_user_id and user_id in self.bot_user_ids:
+                    band_matches[user_id] = band_matches.get(user_id, 0) + 1
+        return {
+            user_id for user_id, count in band_matches.items()
+            if count >= self.min_band_matches
+        }
+
+    def match(self, text, exclude_user_id=None):
+        """
+        Если текст близок к кластеру сообщений ботов, возвращает вердикт в формате
+        ответа analyze_account_with_llm (JSON-строка), иначе None.
+        """
+        bots = self.find_bot_neighbours(text, exclude_user_id)
+        if len(bots) < self.min_bot_users:
+            return None
+        self.matches += 1
+        return json.dumps({
+            "thoughts": f"Сообщение почти совпадает с сообщениями {len(bots)} известных спам-ботов (шаблонный текст)",
+            "is_bot": True,
+            "confidence": 0.95
+        }, ensure_ascii=False)
+
+    async def load(self, db, batch_size=5000):
+        """
+        Загружает корпус сообщений и метки ботов из базы данных. Подписи пачки
+        сообщений считаются в отдельном потоке, чтобы не блокировать цикл событий;
+        в бакеты они добавляются уже в цикле событий, вместе с живыми сообщениями.
+        """
+        for user_id in await db.get_bot_user_ids():
+            self.bot_user_ids.add(user_id)
+        batch = []
+        async for row in db.iter_message_texts(batch_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                await self._add_batch(batch)
+                batch = []
+        await self._add_batch(batch)
+        print(f"Индекс спама загружен: {self.entries} сообщений, {len(self.bot_user_ids)} ботов")
+
+    async def _add_batch(self, rows):
+        if not rows:
+            return
+        keys = await asyncio.to_thread(lambda: [self._band_keys(text) for _, text in rows])
+        for (user_id, _), row_keys in zip(rows, keys):
+            self._add_keys(user_id, row_keys)
+
+    def stats(self):
+        return {
+            "entries": self.entries,
+            "buckets": len(self._buckets),
+            "bot_users": len(self.bot_user_ids),
+            "lookups": self.lookups,
+            "matches": self.matches,
+        }
@@ -0,0 +1,99 @@
+import asyncio
+import re
+import hashlib
+import unicodedata
+from cache import LRUCache
+
+# Вариационные селекторы эмодзи и символы нулевой ширины
+_INVISIBLE_CHARS_RE = re.compile("[\ufe00-\ufe0f\U000e0100-\U000e01ef\u200b-\u200d\u2060\ufeff]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Нормализует текст: NFKC, регистр, пробелы и вариационные селекторы эмодзи"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text)
+    text = _INVISIBLE_CHARS_RE.sub("", text)
+    text = text.casefold()
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def make_moderation_key(message_text, dialog_context=None, channel_name=None, chat_language="ru"):
+    """
+    Ключ кэша модерации: хеш нормализованного текста и контекста, влияющего на вердикт.
+    Автор сообщения в ключ не входит — копипаста с разных аккаунтов даёт один ключ;
+    в промпт вместо имени автора идёт заглушка, а имя подставляется в ответ
+    (llm_api.personalize_verdict). Имена авторов контекста в промпт попадают как есть.
+    """
+    parts = [
+        str(channel_name or ""),
+        (chat_language or "").lower(),
+        *(
+            f"{normalize_text(str(msg.get('sender_name') or ''))}: {normalize_text(msg.get('text'))}"
+            for msg in (dialog_context or [])
+        ),
+        normalize_text(message_text),
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class ModerationVerdictCache:
+    """
+    Кэш вердиктов модерации: LRU+TTL в памяти и необязательный второй уровень в Postgres,
+    чтобы кэш переживал перезапуски.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.ttl = ttl
+        self.store = None
+        self.store_hits = 0
+        self.store_misses = 0
+
+    def attach_store(self, store):
+        """Подключает постоянное хранилище (DatabaseSQLAlchemy) вторым уровнем"""
+        self.store = store
+
+    async def get(self, key):
+        verdict = self.memory.get(key)
+        if verdict is not None or self.store is None:
+            return verdict
+        try:
+            verdict = await self.store.get_moderation_verdict(key, max_age=self.ttl)
+        except Exception as e:
+            print(f"Ошибка чтения кэша модерации из БД: {e}")
+            return None
+        if verdict is None:
+            self.store_misses += 1
+            return None
+        self.store_hits += 1
+        self.memory.set(key, verdict)
+        return verdict
+
+    async def set(self, key, verdict):
+        self.memory.set(key, verdict)
+        if self.store is None:
+            return
+        try:
+            await self.store.save_moderation_verdict(key, verdict)
+        except Exception as e:
+            print(f"Ошибка записи кэша модерации в БД: {e}")
+
+    async def prune_periodically(self, interval):
+        """Удаляет из постоянного хранилища вердикты старше ttl каждые interval секунд"""
+        while True:
+            if self.store is not None:
+                try:
+                    deleted = await self.store.delete_expired_moderation_verdicts(self.ttl)
+                    if deleted:
+                        print(f"Удалено устаревших вердиктов модерации: {deleted}")
+                except Exception as e:
+                    print(f"Ошибка очистки кэша модерации в БД: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["store_hits"] = self.store_hits
+        stats["store_misses"] = self.store_misses
+        return stats
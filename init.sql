@@ -19,7 +19,7 @@ CREATE TABLE IF NOT EXISTS users (
     first_name VARCHAR(255),
     last_name VARCHAR(255),
     full_name VARCHAR(500),
-    profile_photo_base64 TEXT, -- Изображение в base64
+    profile_photo_hash VARCHAR(64), -- Ссылка на image_blobs.hash
     is_bot BOOLEAN DEFAULT false,
     confidence DECIMAL(3,2),
     thoughts TEXT,
@@ -44,7 +44,7 @@ CREATE TABLE IF NOT EXISTS personal_channels (
     user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
     title VARCHAR(255),
     username VARCHAR(255),
-    photo_base64 TEXT, -- Изображение в base64
+    photo_hash VARCHAR(64), -- Ссылка на image_blobs.hash
     created_at TIMESTAMP DEFAULT NOW(),
     updated_at TIMESTAMP DEFAULT NOW()
 );
@@ -55,7 +55,7 @@ CREATE TABLE IF NOT EXISTS channel_posts (
     channel_id INTEGER REFERENCES personal_channels(id) ON DELETE CASCADE,
     post_id BIGINT,
     text TEXT,
-    media_base64 TEXT, -- Изображение в base64
+    media_hash VARCHAR(64), -- Ссылка на image_blobs.hash
     created_at TIMESTAMP DEFAULT NOW()
 );
 
@@ -67,18 +67,50 @@ CREATE TABLE IF NOT EXISTS user_messages (
     message_id BIGINT,
     text TEXT,
     context TEXT,
-    media_base64 TEXT, -- Изображение сообщения в base64
+    media_hash VARCHAR(64), -- Ссылка на image_blobs.hash (изображение сообщения)
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Изображения: хранятся один раз в виде байтов, ключ — SHA-256 содержимого
+CREATE TABLE IF NOT EXISTS image_blobs (
+    hash VARCHAR(64) PRIMARY KEY,
+    mime VARCHAR(50),
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Перцептивные хеши (dHash) аватаров пользователей и их каналов
+CREATE TABLE IF NOT EXISTS avatar_hashes (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+    kind VARCHAR(16), -- user / channel
+    hash BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Кэш вердиктов модерации (ключ — хеш нормализованного текста и контекста)
+CREATE TABLE IF NOT EXISTS moderation_cache (
+    key VARCHAR(64) PRIMARY KEY,
+    verdict TEXT NOT NULL,
     created_at TIMESTAMP DEFAULT NOW()
 );
 
 -- Создание индексов для производительности
 CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
 CREATE INDEX IF NOT EXISTS idx_users_is_bot ON users(is_bot);
-CREATE INDEX IF NOT EXISTS idx_user_messages_user_id ON user_messages(user_id);
+-- Окно последних сообщений пользователя (покрывает и поиск по user_id)
+CREATE INDEX IF NOT EXISTS idx_user_messages_user_created ON user_messages(user_id, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_user_messages_chat_id ON user_messages(chat_id);
 CREATE INDEX IF NOT EXISTS idx_user_messages_created_at ON user_messages(created_at);
 CREATE INDEX IF NOT EXISTS idx_channel_posts_channel_id ON channel_posts(channel_id);
 CREATE INDEX IF NOT EXISTS idx_personal_channels_user_id ON personal_channels(user_id);
+CREATE INDEX IF NOT EXISTS idx_users_profile_photo_hash ON users(profile_photo_hash);
+CREATE INDEX IF NOT EXISTS idx_personal_channels_photo_hash ON personal_channels(photo_hash);
+CREATE INDEX IF NOT EXISTS idx_channel_posts_media_hash ON channel_posts(media_hash);
+CREATE INDEX IF NOT EXISTS idx_user_messages_media_hash ON user_messages(media_hash);
+CREATE INDEX IF NOT EXISTS idx_avatar_hashes_hash ON avatar_hashes(hash);
+CREATE INDEX IF NOT EXISTS idx_avatar_hashes_user_id ON avatar_hashes(user_id);
+CREATE INDEX IF NOT EXISTS idx_moderation_cache_created_at ON moderation_cache(created_at);
 
 -- Вставка начальных данных для чатов (если нужно)
 INSERT INTO chats (id, title, prompt, lang) VALUES 
@@ -0,0 +1,13 @@
+-- Миграция для добавления таблицы перцептивных хешей аватаров
+-- Выполните эту миграцию если у вас уже есть база данных
+
+CREATE TABLE IF NOT EXISTS avatar_hashes (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+    kind VARCHAR(16), -- user / channel
+    hash BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_avatar_hashes_hash ON avatar_hashes(hash);
+CREATE INDEX IF NOT EXISTS idx_avatar_hashes_user_id ON avatar_hashes(user_id);
@@ -0,0 +1,14 @@
+-- Миграция для добавления таблицы кэша вердиктов модерации
+-- Выполните эту миграцию если у вас уже есть база данных
+
+CREATE TABLE IF NOT EXISTS moderation_cache (
+    key VARCHAR(64) PRIMARY KEY,
+    verdict TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Индекс для очистки устаревших записей
+CREATE INDEX IF NOT EXISTS idx_moderation_cache_created_at ON moderation_cache(created_at);
+
+-- Удаляем устаревшие записи (старше суток); дальше бот удаляет их сам раз в MODERATION_CACHE_TTL
+DELETE FROM moderation_cache WHERE created_at < NOW() - INTERVAL '1 day';
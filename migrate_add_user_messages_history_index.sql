@@ -0,0 +1,8 @@
+-- Миграция для добавления составного индекса по истории сообщений пользователя
+-- Выполните эту миграцию если у вас уже есть база данных
+
+-- Окно последних сообщений пользователя (покрывает и поиск по user_id)
+CREATE INDEX IF NOT EXISTS idx_user_messages_user_created ON user_messages(user_id, created_at DESC);
+
+-- Индекс только по user_id больше не нужен: его заменяет составной
+DROP INDEX IF EXISTS idx_user_messages_user_id;
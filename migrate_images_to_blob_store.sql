@@ -0,0 +1,65 @@
+-- Миграция: перенос изображений из base64-колонок в хранилище image_blobs
+-- Изображения сохраняются один раз в виде байтов (ключ — SHA-256 содержимого),
+-- строки хранят только ссылку на хеш. Выполните эту миграцию если у вас уже есть база данных
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS image_blobs (
+    hash VARCHAR(64) PRIMARY KEY,
+    mime VARCHAR(50),
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_photo_hash VARCHAR(64);
+ALTER TABLE personal_channels ADD COLUMN IF NOT EXISTS photo_hash VARCHAR(64);
+ALTER TABLE channel_posts ADD COLUMN IF NOT EXISTS media_hash VARCHAR(64);
+ALTER TABLE user_messages ADD COLUMN IF NOT EXISTS media_hash VARCHAR(64);
+
+DO $$
+DECLARE
+    target RECORD;
+BEGIN
+    FOR target IN
+        SELECT * FROM (VALUES
+            ('users', 'profile_photo_base64', 'profile_photo_hash'),
+            ('personal_channels', 'photo_base64', 'photo_hash'),
+            ('channel_posts', 'media_base64', 'media_hash'),
+            ('user_messages', 'media_base64', 'media_hash')
+        ) AS t(table_name, old_column, new_column)
+    LOOP
+        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = target.table_name AND column_name = target.old_column) THEN
+            RAISE NOTICE 'Колонка %.% уже перенесена', target.table_name, target.old_column;
+            CONTINUE;
+        END IF;
+
+        -- Декодируем data URL один раз, сохраняем байты и проставляем ссылку
+        EXECUTE format($sql$
+            WITH src AS (
+                SELECT id,
+                       decode(split_part(%2$I, ',', 2), 'base64') AS data,
+                       COALESCE(substring(%2$I FROM '^data:([^;]+);base64,'), 'image/jpeg') AS mime
+                FROM %1$I
+                WHERE %2$I LIKE 'data:%%;base64,%%'
+            ), hashed AS (
+                SELECT id, encode(sha256(data), 'hex') AS hash, mime, data FROM src
+            ), blobs AS (
+                INSERT INTO image_blobs (hash, mime, data)
+                SELECT DISTINCT ON (hash) hash, mime, data FROM hashed
+                ON CONFLICT (hash) DO NOTHING
+            )
+            UPDATE %1$I AS t SET %3$I = hashed.hash FROM hashed WHERE t.id = hashed.id
+        $sql$, target.table_name, target.old_column, target.new_column);
+
+        EXECUTE format('ALTER TABLE %I DROP COLUMN %I', target.table_name, target.old_column);
+        RAISE NOTICE 'Колонка %.% перенесена в image_blobs', target.table_name, target.old_column;
+    END LOOP;
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_users_profile_photo_hash ON users(profile_photo_hash);
+CREATE INDEX IF NOT EXISTS idx_personal_channels_photo_hash ON personal_channels(photo_hash);
+CREATE INDEX IF NOT EXISTS idx_channel_posts_media_hash ON channel_posts(media_hash);
+CREATE INDEX IF NOT EXISTS idx_user_messages_media_hash ON user_messages(media_hash);
+
+COMMIT;